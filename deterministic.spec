@@ -26,6 +26,7 @@ hiddenimports += collect_submodules('rapidjson-stubs')
 hiddenimports += collect_submodules('ujson')
 hiddenimports += collect_submodules('blake256')
 hiddenimports += collect_submodules('Cryptodome')
+hiddenimports += collect_submodules('zmq')
 hiddenimports += collect_submodules('pythonnet')
 
 excludes=['__pycache__']
@@ -0,0 +1,113 @@
+'''Bloom filter for probabilistic set membership.'''
+
+from hashlib import blake2b
+
+from electrumz.lib.util import pack_le_uint32, unpack_le_uint32
+
+
+class BloomFilter:
+    '''A scalable bloom filter over byte-string keys.
+
+    Membership tests have no false negatives.  Keys cannot be removed.
+    The first layer has 10 bits per key, for false positives at under
+    1%.  When the newest layer reaches its capacity a new layer of
+    twice the capacity is added, with 2 more bits per key than the
+    last so its false positive rate is about 0.38 times the last's.
+    The rates of all layers sum to under 1.4%.  Size the filter for
+    the expected number of keys to avoid layers altogether.
+    '''
+
+    # Bump when the hashing or layout changes
+    VERSION = 2
+    BITS_PER_KEY = 10
+    EXTRA_BITS_PER_LAYER = 2
+
+    def __init__(self, capacity):
+        self.count = 0
+        self.layers = []
+        self._add_layer(max(capacity, 1024))
+
+    @classmethod
+    def _layer_shape(cls, index, capacity):
+        '''Return (nbytes, hash count) of the layer at index.'''
+        bits_per_key = cls.BITS_PER_KEY + index * cls.EXTRA_BITS_PER_LAYER
+        hashes = max(round(bits_per_key * 0.693), 1)
+        return (capacity * bits_per_key + 7) // 8, hashes
+
+    def _add_layer(self, capacity):
+        nbytes, hashes = self._layer_shape(len(self.layers), capacity)
+        self.layers.append((capacity, hashes, bytearray(nbytes)))
+        self.layer_count = 0
+
+    @staticmethod
+    def _hashes(key):
+        '''Return three hashes of key; layers derive their indices from
+        them so the key is hashed once however many layers there are.'''
+        digest = blake2b(key, digest_size=24).digest()
+        return (int.from_bytes(digest[:8], 'little'),
+                int.from_bytes(digest[8:16], 'little') | 1,
+                int.from_bytes(digest[16:], 'little'))
+
+    @staticmethod
+    def _bit_indices(hashes, layer_index, count, nbits):
+        h1, h2, h3 = hashes
+        h1 += layer_index * h3
+        return [(h1 + n * h2) % nbits for n in range(count)]
+
+    def add(self, key):
+        capacity, _count, bits = self.layers[-1]
+        if self.layer_count >= capacity:
+            self._add_layer(capacity * 2)
+        _capacity, count, bits = self.layers[-1]
+        indices = self._bit_indices(self._hashes(key), len(self.layers) - 1,
+                                    count, len(bits) * 8)
+        for index in indices:
+            bits[index >> 3] |= 1 << (index & 7)
+        self.layer_count += 1
+        self.count += 1
+
+    def __contains__(self, key):
+        hashes = self._hashes(key)
+        bit_indices = self._bit_indices
+        for layer_index, (_capacity, count, bits) in enumerate(self.layers):
+            if all(bits[index >> 3] & (1 << (index & 7))
+                   for index in bit_indices(hashes, layer_index, count,
+                                            len(bits) * 8)):
+                return True
+        return False
+
+    def memsize(self):
+        return sum(len(bits) for _capacity, _count, bits in self.layers)
+
+    def to_bytes(self):
+        '''Serialize the filter.'''
+        parts = [pack_le_uint32(len(self.layers))]
+        for capacity, _count, bits in self.layers:
+            parts.append(pack_le_uint32(capacity))
+            parts.append(bits)
+        parts.append(pack_le_uint32(self.layer_count))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Deserialize a filter written by to_bytes().'''
+        nlayers, = unpack_le_uint32(data[:4])
+        cursor = 4
+        layers = []
+        count = 0
+        for index in range(nlayers):
+            capacity, = unpack_le_uint32(data[cursor: cursor + 4])
+            cursor += 4
+            size, hashes = cls._layer_shape(index, capacity)
+            layers.append((capacity, hashes,
+                           bytearray(data[cursor: cursor + size])))
+            cursor += size
+            count += capacity
+        layer_count, = unpack_le_uint32(data[cursor: cursor + 4])
+        if cursor + 4 != len(data) or not layers:
+            raise ValueError('bad bloom filter serialization')
+        result = cls.__new__(cls)
+        result.layers = layers
+        result.layer_count = layer_count
+        result.count = count - layers[-1][0] + layer_count
+        return result
@@ -12,7 +12,6 @@ from electrumz.lib.hash import Base58, double_sha256, hash_to_hex_str
 from electrumz.lib.hash import HASHX_LEN
 from electrumz.lib.script import ScriptPubKey
 import electrumz.lib.tx as lib_tx
-from electrumz.lib.tx import Tx
 
 import electrumz.server.block_processor as block_proc
 import electrumz.server.daemon as daemon
@@ -21,10 +20,13 @@ from electrumz.server.session import ElectrumZ
 
 @dataclass
 class Block:
+    '''A block's transactions are (tx_hash, prevouts, outputs) triples;
+    see Deserializer.read_tx_block_index().'''
     __slots__ = "raw", "header", "transactions"
     raw: bytes
     header: bytes
-    transactions: Sequence[Tuple[Tx, bytes]]
+    transactions: Sequence[Tuple[bytes, Sequence[Tuple[bytes, int]],
+                                 Sequence[Tuple[bytes, int]]]]
 
 
 class CoinError(Exception):
@@ -226,8 +228,8 @@ class Coin:
     def block(cls, raw_block, height):
         '''Return a Block namedtuple given a raw block and its height.'''
         header = cls.block_header(raw_block, height)
-        txs = cls.DESERIALIZER(raw_block, start=len(header)).read_tx_block()
-        return Block(raw_block, header, txs)
+        deserializer = cls.DESERIALIZER(raw_block, start=len(header))
+        return Block(raw_block, header, deserializer.read_tx_block_index())
 
     @classmethod
     def decimal_value(cls, value):
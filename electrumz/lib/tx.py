@@ -132,6 +132,20 @@ class Deserializer:
         # Some coins have excess data beyond the end of the transactions
         return [read() for _ in range(self._read_varint())]
 
+    def read_tx_block_index(self):
+        '''Returns a list of (tx_hash, prevouts, outputs) triples, all that
+        block indexing needs.  prevouts is a list of (prev_hash,
+        prev_idx) pairs excluding generation inputs, and outputs a
+        list of (pk_script, value) pairs.
+
+        Deserializers can override this to avoid building Tx objects.
+        '''
+        return [(tx_hash,
+                 [(txin.prev_hash, txin.prev_idx) for txin in tx.inputs
+                  if not txin.is_generation()],
+                 [(txout.pk_script, txout.value) for txout in tx.outputs])
+                for tx, tx_hash in self.read_tx_block()]
+
     def _read_inputs(self):
         read_input = self._read_input
         return [read_input() for i in range(self._read_varint())]
@@ -455,24 +469,70 @@ class DeserializerEquihashSegWit(DeserializerSegWit, DeserializerEquihash):
 
 
 class DeserializerZcash(DeserializerEquihash):
-    def read_tx(self):
+    def _read_version(self):
         header = self._read_le_uint32()
         overwintered = ((header >> 31) == 1)
         if overwintered:
-            version = header & 0x7fffffff
             self.cursor += 4  # versionGroupId
-        else:
-            version = header
-
-        is_overwinter_v3 = version == 3
-        is_sapling_v4 = version == 4
+            return header & 0x7fffffff
+        return header
 
+    def read_tx(self):
+        version = self._read_version()
         base_tx = Tx(
             version,
             self._read_inputs(),    # inputs
             self._read_outputs(),   # outputs
             self._read_le_uint32()  # locktime
         )
+        self._skip_shielded(version)
+        return base_tx
+
+    def read_tx_block_index(self):
+        '''Parse the transparent parts of the block's transactions without
+        building Tx objects.  Input scripts and the shielded parts are
+        skipped, and the tx hashes computed over a memoryview.'''
+        binary = self.binary
+        view = memoryview(binary)
+        tx_hash_fn = self.TX_HASH_FN
+        read_varint = self._read_varint
+        skip_shielded = self._skip_shielded
+        result = []
+        for _ in range(read_varint()):
+            start = self.cursor
+            version = self._read_version()
+
+            prevouts = []
+            for _ in range(read_varint()):
+                cursor = self.cursor
+                prev_hash = binary[cursor: cursor + 32]
+                prev_idx, = unpack_le_uint32_from(binary, cursor + 32)
+                self.cursor = cursor + 36
+                script_len = read_varint()
+                self.cursor += script_len + 4  # script, sequence
+                if prev_idx != MINUS_1 or prev_hash != ZERO:
+                    prevouts.append((prev_hash, prev_idx))
+
+            outputs = []
+            for _ in range(read_varint()):
+                value, = unpack_le_int64_from(binary, self.cursor)
+                self.cursor += 8
+                script_len = read_varint()
+                cursor = self.cursor
+                self.cursor = cursor + script_len
+                outputs.append((binary[cursor: cursor + script_len], value))
+
+            self.cursor += 4  # locktime
+            skip_shielded(version)
+            assert self.cursor <= self.binary_length
+            result.append((tx_hash_fn(view[start: self.cursor]), prevouts,
+                           outputs))
+        return result
+
+    def _skip_shielded(self, version):
+        '''Skip the fields following the locktime.'''
+        is_overwinter_v3 = version == 3
+        is_sapling_v4 = version == 4
 
         if is_overwinter_v3 or is_sapling_v4:
             self.cursor += 4  # expiryHeight
@@ -486,7 +546,7 @@ class DeserializerZcash(DeserializerEquihash):
             self.cursor += shielded_output_size * 948  # vShieldedOutput
             has_shielded = shielded_spend_size > 0 or shielded_output_size > 0
 
-        if base_tx.version >= 2:
+        if version >= 2:
             joinsplit_size = self._read_varint()
             if joinsplit_size > 0:
                 joinsplit_desc_len = 1506 + (192 if is_sapling_v4 else 296)
@@ -498,8 +558,6 @@ class DeserializerZcash(DeserializerEquihash):
         if is_sapling_v4 and has_shielded:
             self.cursor += 64  # bindingSig
 
-        return base_tx
-
 
 @dataclass
 class TxPIVX:
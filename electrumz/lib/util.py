@@ -8,7 +8,9 @@ import asyncio
 import inspect
 from ipaddress import ip_address
 import logging
+import mmap
 import sys
+import threading
 from collections.abc import Container, Mapping
 from struct import Struct
 
@@ -207,6 +209,96 @@ class LogicalFile:
         return f
 
 
+class MappedLogicalFile(LogicalFile):
+    '''A LogicalFile whose segment files are kept memory-mapped for
+    reading, so reads do not need any system calls.
+
+    Writes go through the files as normal and drop the mappings of
+    the segments they touch; they are remapped on the next read.
+    '''
+
+    def __init__(self, prefix, digits, file_size):
+        super().__init__(prefix, digits, file_size)
+        self.maps = {}
+        self.mapped = True
+        # Serializes mapping a segment with dropping it after a write,
+        # so a reader cannot store a mapping older than the write
+        self.maps_lock = threading.Lock()
+
+    def _map(self, file_num):
+        '''Return the mapping of the segment, or None if it does not
+        exist or is empty.'''
+        segment = self.maps.get(file_num)
+        if segment is None:
+            filename = self.filename_fmt.format(file_num)
+            with self.maps_lock:
+                segment = self.maps.get(file_num)
+                if segment is not None:
+                    return segment
+                try:
+                    with open(filename, 'rb') as f:
+                        segment = mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_READ)
+                except (FileNotFoundError, ValueError):
+                    # ValueError is raised for an empty file
+                    return None
+                self.maps[file_num] = segment
+        return segment
+
+    def read(self, start, size=-1):
+        '''Read up to size bytes from the virtual file, starting at offset
+        start, and return them.
+
+        If size is -1 all bytes are read.'''
+        if not self.mapped:
+            return super().read(start, size)
+        parts = []
+        while size != 0:
+            file_num, offset = divmod(start, self.file_size)
+            try:
+                segment = self._map(file_num)
+            except OSError:
+                # Out of address space; fall back to file reads
+                self.mapped = False
+                self.maps.clear()
+                return b''.join(parts) + super().read(start, size)
+            if segment is None:
+                break
+            end = len(segment) if size < 0 else min(len(segment), offset + size)
+            part = segment[offset:end]
+            if not part:
+                break
+            parts.append(part)
+            start += len(part)
+            if size > 0:
+                size -= len(part)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def read_view(self, start, size):
+        '''Return a memoryview of size bytes starting at offset start.
+        Zero-copy if the range lies within one segment.'''
+        if self.mapped:
+            file_num, offset = divmod(start, self.file_size)
+            try:
+                segment = self._map(file_num)
+            except OSError:
+                segment = None
+            if segment is not None and offset + size <= len(segment):
+                return memoryview(segment)[offset: offset + size]
+        return memoryview(self.read(start, size))
+
+    def write(self, start, b):
+        '''Write the bytes-like object, b, to the underlying virtual file.'''
+        if b:
+            first = start // self.file_size
+            last = (start + len(b) - 1) // self.file_size
+        super().write(start, b)
+        if b:
+            with self.maps_lock:
+                for file_num in range(first, last + 1):
+                    self.maps.pop(file_num, None)
+
+
 def open_file(filename, create=False):
     '''Open the file name.  Return its handle.'''
     try:
@@ -5,6 +5,9 @@
 
 import asyncio
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Sequence, Tuple, List, Callable, Optional, TYPE_CHECKING, Type
 
 from aiorpcx import run_in_thread, CancelledError
@@ -16,9 +19,9 @@ from electrumz.lib.script import is_unspendable_legacy, is_unspendable_genesis
 from electrumz.lib.util import (
     chunks, class_logger, pack_le_uint32, pack_le_uint64, unpack_le_uint64, OldTaskGroup
 )
-from electrumz.lib.tx import Tx
 from electrumz.server.db import FlushData, COMP_TXID_LEN, DB
 from electrumz.server.history import TXNUM_LEN
+from electrumz.server.utxo_cache import UTXOCache
 
 if TYPE_CHECKING:
     from electrumz.lib.coins import Coin
@@ -26,8 +29,33 @@ if TYPE_CHECKING:
     from electrumz.server.controller import Notifications
 
 
+def parse_blocks(coin: Type['Coin'], raw_blocks: Sequence[bytes], first: int,
+                 strip_raw=False):
+    '''Deserialize raw blocks starting at height first.  Module level so
+    it can run in a worker process.
+
+    If strip_raw the blocks are returned with empty raw bytes, so they
+    are not pickled back to the caller, which still has them.'''
+    blocks = [coin.block(raw_block, first + n)
+              for n, raw_block in enumerate(raw_blocks)]
+    if strip_raw:
+        for block in blocks:
+            block.raw = b''
+    return blocks
+
+
 class Prefetcher:
-    '''Prefetches blocks (in the forward direction only).'''
+    '''Prefetches blocks (in the forward direction only).
+
+    Fetched blocks are deserialized before being queued, in a pool of
+    worker processes if parse_workers is non-zero, so that parsing
+    overlaps with the block processor's UTXO and history work.
+
+    Up to max_fetches ranges of blocks are fetched concurrently, each
+    over its own daemon connection, and queued in height order.  The
+    number in flight grows by one whilst the daemon's latency per byte
+    stays near the best seen, and halves when it rises or on error.
+    '''
 
     def __init__(
             self,
@@ -36,6 +64,8 @@ class Prefetcher:
             blocks_event: asyncio.Event,
             *,
             polling_delay_secs,
+            parse_workers=0,
+            max_fetches=1,
     ):
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.daemon = daemon
@@ -47,6 +77,8 @@ class Prefetcher:
         self.fetched_height = None
         self.semaphore = asyncio.Semaphore()
         self.refill_event = asyncio.Event()
+        # Set when the daemon announces a block, to cut short polling
+        self.new_block_event = asyncio.Event()
         # The prefetched block cache size.  The min cache size has
         # little effect on sync time.
         self.cache_size = 0
@@ -54,17 +86,37 @@ class Prefetcher:
         # This makes the first fetch be 10 blocks
         self.ave_size = self.min_cache_size // 10
         self.polling_delay = polling_delay_secs
+        self.parse_workers = parse_workers
+        self.executor = None
+        # Concurrent range fetches
+        self.max_fetches = max(max_fetches, 1)
+        self.window = 1
+        # Best recent daemon latency in seconds per MB
+        self.base_latency = None
 
     async def main_loop(self, bp_height):
         '''Loop forever polling for more blocks.'''
+        if self.parse_workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+            self.logger.info(f'parsing blocks with {self.parse_workers:,d} '
+                             f'worker processes')
+        try:
+            await self._main_loop(bp_height)
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+    async def _main_loop(self, bp_height):
         await self.reset_height(bp_height)
         while True:
             try:
                 # Sleep a while if there is nothing to prefetch
                 await self.refill_event.wait()
                 if not await self._prefetch_blocks():
-                    await asyncio.sleep(self.polling_delay)
+                    await self._wait_for_new_block()
             except DaemonError as e:
+                self.window = max(self.window // 2, 1)
                 self.logger.info(f'ignoring daemon error: {e}')
             except asyncio.CancelledError as e:
                 self.logger.info(f'cancelled; prefetcher stopping {e}')
@@ -72,6 +124,18 @@ class Prefetcher:
             except Exception:
                 self.logger.exception(f'ignoring unexpected exception')
 
+    async def _wait_for_new_block(self):
+        '''Sleep for the polling delay, or until a block is announced.'''
+        try:
+            await asyncio.wait_for(self.new_block_event.wait(), self.polling_delay)
+        except asyncio.TimeoutError:
+            pass
+        self.new_block_event.clear()
+
+    def on_block_notification(self):
+        '''Called when the daemon announces a new block.'''
+        self.new_block_event.set()
+
     def get_prefetched_blocks(self):
         '''Called by block processor when it is processing queued blocks.'''
         blocks = self.blocks
@@ -103,6 +167,69 @@ class Prefetcher:
         else:
             self.logger.info(f'caught up to daemon height {daemon_height:,d}')
 
+    async def _parse_blocks(self, raw_blocks, first):
+        '''Return the raw blocks deserialized.  Work is split across the
+        worker processes if there are any, otherwise done in a thread.'''
+        executor = self.executor
+        if executor:
+            loop = asyncio.get_running_loop()
+            size = -(-len(raw_blocks) // self.parse_workers)
+            futures = [loop.run_in_executor(executor, parse_blocks, self.coin,
+                                            raw_blocks[n: n + size], first + n,
+                                            True)
+                       for n in range(0, len(raw_blocks), size)]
+            try:
+                results = await asyncio.gather(*futures)
+            except BrokenProcessPool:
+                self.logger.error('block parsing process pool broke; '
+                                  'parsing in a thread instead')
+                self.executor = None
+                executor.shutdown(wait=False)
+            else:
+                blocks = [block for blocks in results for block in blocks]
+                for block, raw_block in zip(blocks, raw_blocks):
+                    block.raw = raw_block
+                return blocks
+        return await run_in_thread(parse_blocks, self.coin, raw_blocks, first)
+
+    async def _fetch_range(self, first, count):
+        '''Fetch and parse count blocks from height first.  Returns a
+        (blocks, size) pair.'''
+        daemon = self.daemon
+        start = time.monotonic()
+        hex_hashes = await daemon.block_hex_hashes(first, count)
+        if self.caught_up:
+            self.logger.info(f'new block height {first + count-1:,d} '
+                             f'hash {hex_hashes[-1]}')
+        raw_blocks = await daemon.raw_blocks(hex_hashes)
+
+        assert count == len(raw_blocks)
+
+        # Special handling for genesis block
+        if first == 0:
+            raw_blocks[0] = self.coin.genesis_block(raw_blocks[0])
+            self.logger.info(f'verified genesis block with hash '
+                             f'{hex_hashes[0]}')
+
+        size = sum(len(raw_block) for raw_block in raw_blocks)
+        self._update_window(time.monotonic() - start, size)
+        blocks = await self._parse_blocks(raw_blocks, first)
+        return blocks, size
+
+    def _update_window(self, elapsed, size):
+        '''Adjust the number of concurrent fetches given a fetch of size
+        bytes that took elapsed seconds.'''
+        latency = elapsed / max(size / 1_000_000, 0.01)
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            # Decay so the base adapts to a slower daemon or network
+            self.base_latency *= 1.05
+        if latency <= self.base_latency * 1.5:
+            self.window = min(self.window + 1, self.max_fetches)
+        else:
+            self.window = max(self.window // 2, 1)
+
     async def _prefetch_blocks(self):
         '''Prefetch some blocks and put them on the queue.
 
@@ -111,42 +238,53 @@ class Prefetcher:
         daemon = self.daemon
         daemon_height = await daemon.height()
         async with self.semaphore:
-            while self.cache_size < self.min_cache_size:
-                first = self.fetched_height + 1
-                # Try and catch up all blocks but limit to room in cache.
-                cache_room = max(self.min_cache_size // self.ave_size, 1)
-                count = min(daemon_height - self.fetched_height, cache_room)
-                # Don't make too large a request
-                count = min(self.coin.max_fetch_blocks(first), max(count, 0))
-                if not count:
-                    self.caught_up = True
-                    return False
-
-                hex_hashes = await daemon.block_hex_hashes(first, count)
-                if self.caught_up:
-                    self.logger.info(f'new block height {first + count-1:,d} '
-                                     f'hash {hex_hashes[-1]}')
-                blocks = await daemon.raw_blocks(hex_hashes)
-
-                assert count == len(blocks)
-
-                # Special handling for genesis block
-                if first == 0:
-                    blocks[0] = self.coin.genesis_block(blocks[0])
-                    self.logger.info(f'verified genesis block with hash '
-                                     f'{hex_hashes[0]}')
-
-                # Update our recent average block size estimate
-                size = sum(len(block) for block in blocks)
-                if count >= 10:
-                    self.ave_size = size // count
-                else:
-                    self.ave_size = (size + (10 - count) * self.ave_size) // 10
-
-                self.blocks.extend(blocks)
-                self.cache_size += size
-                self.fetched_height += count
-                self.blocks_event.set()
+            # (count, task) pairs in height order
+            fetches = deque()
+            next_height = self.fetched_height + 1
+            try:
+                while True:
+                    # Fill the window whilst there is room in the cache,
+                    # estimating the size of blocks in flight
+                    room = self.min_cache_size - self.cache_size
+                    room -= sum(count for count, _ in fetches) * self.ave_size
+                    while len(fetches) < self.window and room > 0:
+                        # Split the room across the free window slots
+                        cache_room = max(room // self.ave_size, 1)
+                        count = max(cache_room // (self.window - len(fetches)), 1)
+                        count = min(daemon_height - next_height + 1, count)
+                        # Don't make too large a request
+                        count = min(self.coin.max_fetch_blocks(next_height),
+                                    max(count, 0))
+                        if not count:
+                            break
+                        task = asyncio.ensure_future(
+                            self._fetch_range(next_height, count))
+                        fetches.append((count, task))
+                        next_height += count
+                        room -= count * self.ave_size
+
+                    if not fetches:
+                        if room > 0:
+                            self.caught_up = True
+                            return False
+                        break
+
+                    count, task = fetches.popleft()
+                    blocks, size = await task
+
+                    # Update our recent average block size estimate
+                    if count >= 10:
+                        self.ave_size = size // count
+                    else:
+                        self.ave_size = (size + (10 - count) * self.ave_size) // 10
+
+                    self.blocks.extend(blocks)
+                    self.cache_size += size
+                    self.fetched_height += count
+                    self.blocks_event.set()
+            finally:
+                for _count, task in fetches:
+                    task.cancel()
 
         self.refill_event.clear()
         return True
@@ -175,6 +313,8 @@ class BlockProcessor:
         self.prefetcher = Prefetcher(
             daemon, env.coin, self.blocks_event,
             polling_delay_secs=env.daemon_poll_interval_blocks_msec/1000,
+            parse_workers=env.block_parse_workers,
+            max_fetches=env.prefetch_window,
         )
         self.logger = class_logger(__name__, self.__class__.__name__)
 
@@ -194,8 +334,20 @@ class BlockProcessor:
         self.undo_infos = []  # type: List[Tuple[Sequence[bytes], int]]
 
         # UTXO cache
-        self.utxo_cache = {}
+        self.utxo_cache = UTXOCache()
         self.db_deletes = []
+        # hashX -> [value_sats, utxo_count] spent from the DB, negated
+        self.balance_deltas = {}
+
+        # Background flushing during sync.  pending_adds is the UTXO
+        # cache being flushed, readable until its flush completes.
+        self._flush_future = None
+        self.pending_adds = None
+        self._spare_cache = None
+
+        # UTXOs the blocks being advanced spend from the DB, read ahead
+        # in key order: tx_hash + idx_packed -> (hdb_key, cache value)
+        self.prefetched_utxos = {}
 
         # If the lock is successfully acquired, in-memory chain state
         # is consistent with self.height
@@ -215,15 +367,12 @@ class BlockProcessor:
                 return await run_in_thread(func, *args)
         return await asyncio.shield(run_in_thread_locked())
 
-    async def check_and_advance_blocks(self, raw_blocks):
-        '''Process the list of raw blocks passed.  Detects and handles
-        reorgs.
+    async def check_and_advance_blocks(self, blocks):
+        '''Process the list of deserialized blocks passed.  Detects and
+        handles reorgs.
         '''
-        if not raw_blocks:
+        if not blocks:
             return
-        first = self.height + 1
-        blocks = [self.coin.block(raw_block, first + n)
-                  for n, raw_block in enumerate(raw_blocks)]
         headers = [block.header for block in blocks]
         hprevs = [self.coin.header_prevhash(h) for h in headers]
         chain = [self.tip] + [self.coin.header_hash(h) for h in headers[:-1]]
@@ -234,7 +383,7 @@ class BlockProcessor:
             await self._maybe_flush()
             if not self.db.first_sync:
                 s = '' if len(blocks) == 1 else 's'
-                blocks_size = sum(len(block) for block in raw_blocks) / 1_000_000
+                blocks_size = sum(len(block.raw) for block in blocks) / 1_000_000
                 self.logger.info(f'processed {len(blocks):,d} block{s} size {blocks_size:.2f} MB '
                                  f'in {time.monotonic() - start:.1f}s')
             if self._caught_up_event.is_set():
@@ -353,14 +502,50 @@ class BlockProcessor:
         assert self.state_lock.locked()
         return FlushData(self.height, self.tx_count, self.headers,
                          self.tx_hashes, self.undo_infos, self.utxo_cache,
-                         self.db_deletes, self.tip)
+                         self.db_deletes, self.balance_deltas, self.tip)
 
     async def flush(self, flush_utxos):
+        await self._wait_for_background_flush()
+
         def flush():
             self.db.flush_dbs(self.flush_data(), flush_utxos,
                               self.estimate_txs_remaining)
         await self.run_in_thread_with_lock(flush)
 
+    async def _background_flush(self, flush_utxos):
+        '''Flush a snapshot of the caches in a thread whilst blocks are
+        processed into fresh ones.  Only one flush is in progress at a
+        time.'''
+        await self._wait_for_background_flush()
+        async with self.state_lock:
+            flush_data = self.flush_data()
+            flush_data.unflushed_history = self.db.history.take_unflushed()
+            self.headers = []
+            self.tx_hashes = []
+            if flush_utxos:
+                self.undo_infos = []
+                self.pending_adds = self.utxo_cache
+                spare_cache = self._spare_cache
+                self.utxo_cache = (spare_cache if spare_cache is not None
+                                   else UTXOCache())
+                self._spare_cache = None
+                self.db_deletes = []
+                self.balance_deltas = {}
+        self._flush_future = asyncio.ensure_future(run_in_thread(
+            self.db.flush_dbs, flush_data, flush_utxos, self.estimate_txs_remaining))
+
+    async def _wait_for_background_flush(self):
+        future = self._flush_future
+        if future is None:
+            return
+        # Shielded so the flush completes if we are cancelled
+        await asyncio.shield(future)
+        self._flush_future = None
+        if self.pending_adds is not None:
+            # Now empty; reuse it rather than growing a new table
+            self._spare_cache = self.pending_adds
+            self.pending_adds = None
+
     async def _maybe_flush(self):
         # If caught up, flush everything as client queries are
         # performed on the DB.
@@ -369,16 +554,18 @@ class BlockProcessor:
         elif time.monotonic() > self.next_cache_check:
             flush_arg = self.check_cache_size()
             if flush_arg is not None:
-                await self.flush(flush_arg)
+                await self._background_flush(flush_arg)
             self.next_cache_check = time.monotonic() + 30
 
     def check_cache_size(self):
         '''Flush a cache if it gets too big.'''
         # Good average estimates based on traversal of subobjects and
-        # requesting size from Python (see deep_getsizeof).
+        # requesting size from Python (see deep_getsizeof).  The UTXO
+        # cache knows its exact size.
         one_MB = 1000*1000
-        utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
+        utxo_cache_size = self.utxo_cache.memsize()
+        db_deletes_size = (len(self.db_deletes) * 57
+                           + len(self.balance_deltas) * 150)
         hist_cache_size = self.db.history.unflushed_memsize()
         # Roughly ntxs * 32 + nblocks * 42
         tx_hash_size = ((self.tx_count - self.db.fs_tx_count) * 32
@@ -406,6 +593,7 @@ class BlockProcessor:
         height = self.height
         genesis_activation = self.coin.GENESIS_ACTIVATION
 
+        self.prefetch_utxos(blocks)
         for block in blocks:
             height += 1
             is_unspendable = (is_unspendable_genesis if height >= genesis_activation
@@ -414,6 +602,7 @@ class BlockProcessor:
             if height >= min_height:
                 self.undo_infos.append((undo_info, height))
                 self.db.write_raw_block(block.raw, height)
+        assert not self.prefetched_utxos
 
         headers = [block.header for block in blocks]
         self.height = height
@@ -422,12 +611,33 @@ class BlockProcessor:
         self.tip_advanced_event.set()
         self.tip_advanced_event.clear()
 
+    def prefetch_utxos(self, blocks):
+        '''Read ahead from the DB all the UTXOs the blocks spend that are
+        neither cached nor created by the blocks themselves.'''
+        created = {tx_hash for block in blocks
+                   for tx_hash, _prevouts, _outputs in block.transactions}
+        utxo_cache = self.utxo_cache
+        pending_adds = self.pending_adds
+        to_le_uint32 = pack_le_uint32
+        keys = []
+        for block in blocks:
+            for _tx_hash, prevouts, _outputs in block.transactions:
+                for prev_hash, prev_idx in prevouts:
+                    if prev_hash in created:
+                        continue
+                    key = prev_hash + to_le_uint32(prev_idx)
+                    if key in utxo_cache or (pending_adds is not None
+                                             and key in pending_adds):
+                        continue
+                    keys.append(key)
+        self.prefetched_utxos = self.db.read_utxos(keys) if keys else {}
+
     def advance_txs(
             self,
-            txs: Sequence[Tuple[Tx, bytes]],
+            txs: Sequence[Tuple[bytes, Sequence, Sequence]],
             is_unspendable: Callable[[bytes], bool],
     ) -> Sequence[bytes]:
-        self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
+        self.tx_hashes.append(b''.join(tx_hash for tx_hash, _, _ in txs))
 
         # Use local vars for speed in the loops
         undo_info = []
@@ -442,30 +652,28 @@ class BlockProcessor:
         to_le_uint32 = pack_le_uint32
         to_le_uint64 = pack_le_uint64
 
-        for tx, tx_hash in txs:
+        for tx_hash, prevouts, outputs in txs:
             hashXs = []
             append_hashX = hashXs.append
             tx_numb = to_le_uint64(tx_num)[:TXNUM_LEN]
 
             # Spend the inputs
-            for txin in tx.inputs:
-                if txin.is_generation():
-                    continue
-                cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
+            for prev_hash, prev_idx in prevouts:
+                cache_value = spend_utxo(prev_hash, prev_idx)
                 undo_info_append(cache_value)
                 append_hashX(cache_value[:HASHX_LEN])
 
             # Add the new UTXOs
-            for idx, txout in enumerate(tx.outputs):
+            for idx, (pk_script, value) in enumerate(outputs):
                 # Ignore unspendable outputs
-                if is_unspendable(txout.pk_script):
+                if is_unspendable(pk_script):
                     continue
 
                 # Get the hashX
-                hashX = script_hashX(txout.pk_script)
+                hashX = script_hashX(pk_script)
                 append_hashX(hashX)
                 put_utxo(tx_hash + to_le_uint32(idx),
-                         hashX + tx_numb + to_le_uint64(txout.value))
+                         hashX + tx_numb + to_le_uint64(value))
 
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -509,7 +717,7 @@ class BlockProcessor:
 
     def backup_txs(
             self,
-            txs: Sequence[Tuple[Tx, bytes]],
+            txs: Sequence[Tuple[bytes, Sequence, Sequence]],
             is_unspendable: Callable[[bytes], bool],
     ):
         # Prevout values, in order down the block (coinbase first if present)
@@ -526,11 +734,11 @@ class BlockProcessor:
         touched = self.touched
         undo_entry_len = HASHX_LEN + TXNUM_LEN + 8
 
-        for tx, tx_hash in reversed(txs):
-            for idx, txout in enumerate(tx.outputs):
+        for tx_hash, prevouts, outputs in reversed(txs):
+            for idx, (pk_script, _value) in enumerate(outputs):
                 # Spend the TX outputs.  Be careful with unspendable
                 # outputs - we didn't save those in the first place.
-                if is_unspendable(txout.pk_script):
+                if is_unspendable(pk_script):
                     continue
 
                 # Get the hashX
@@ -539,12 +747,10 @@ class BlockProcessor:
                 touched.add(hashX)
 
             # Restore the inputs
-            for txin in reversed(tx.inputs):
-                if txin.is_generation():
-                    continue
+            for prev_hash, prev_idx in reversed(prevouts):
                 n -= undo_entry_len
                 undo_item = undo_info[n:n + undo_entry_len]
-                put_utxo(txin.prev_hash + pack_le_uint32(txin.prev_idx), undo_item)
+                put_utxo(prev_hash + pack_le_uint32(prev_idx), undo_item)
                 hashX = undo_item[:HASHX_LEN]
                 touched.add(hashX)
 
@@ -558,23 +764,22 @@ class BlockProcessor:
     performance during initial sync, because then it is possible to
     spend UTXOs without ever going to the database (other than as an
     entry in the address history, and there is only one such entry per
-    TX not per UTXO).  So store them in a Python dictionary with
-    binary keys and values.
+    TX not per UTXO).  So store them in a UTXOCache, a hash table of
+    fixed-width binary records.
 
       Key:    TX_HASH + TX_IDX           (32 + 4 = 36 bytes)
       Value:  HASHX + TX_NUM + VALUE     (11 + 5 + 8 = 24 bytes)
 
-    That's 60 bytes of raw data in-memory.  Python dictionary overhead
-    means each entry actually uses about 205 bytes of memory.  So
-    almost 5 million UTXOs can fit in 1GB of RAM.  There are
-    approximately 42 million UTXOs on bitcoin mainnet at height
-    433,000.
+    That's 60 bytes of raw data in-memory.  With its index each entry
+    uses about 80 to 110 bytes of memory, against up to 205 bytes in a
+    Python dictionary of bytes objects.  So about 10 million UTXOs can
+    fit in 1GB of RAM.
 
     Semantics:
 
-      add:   Add it to the cache dictionary.
+      add:   Add it to the cache.
 
-      spend: Remove it if in the cache dictionary.  Otherwise it's
+      spend: Remove it if in the cache.  Otherwise it's
              been flushed to the DB.  Each UTXO is responsible for two
              entries in the DB.  Mark them for deletion in the next
              cache flush.
@@ -618,6 +823,28 @@ class BlockProcessor:
         if cache_value:
             return cache_value
 
+        # Then the UTXOs being flushed in the background.  Once flushed
+        # they are in the DB, so delete them in the next flush.
+        if self.pending_adds is not None:
+            cache_value = self.pending_adds.get(tx_hash + idx_packed)
+            if cache_value:
+                hashX = cache_value[:HASHX_LEN]
+                suffix = idx_packed + cache_value[HASHX_LEN:HASHX_LEN+TXNUM_LEN]
+                self.db_deletes.append(b'h' + tx_hash[:COMP_TXID_LEN] + suffix)
+                self.db_deletes.append(b'u' + hashX + suffix)
+                self._add_balance_delta(hashX, cache_value[-8:])
+                return cache_value
+
+        # Then those read ahead from the DB
+        prefetched = self.prefetched_utxos.pop(tx_hash + idx_packed, None)
+        if prefetched:
+            hdb_key, cache_value = prefetched
+            hashX = cache_value[:HASHX_LEN]
+            self.db_deletes.append(hdb_key)
+            self.db_deletes.append(b'u' + hashX + hdb_key[-4-TXNUM_LEN:])
+            self._add_balance_delta(hashX, cache_value[-8:])
+            return cache_value
+
         # Spend it from the DB.
         txnum_padding = bytes(8-TXNUM_LEN)
 
@@ -626,6 +853,11 @@ class BlockProcessor:
         prefix = b'h' + tx_hash[:COMP_TXID_LEN] + idx_packed
         candidates = {db_key: hashX for db_key, hashX
                       in self.db.utxo_db.iterator(prefix=prefix)}
+        if len(candidates) > 1:
+            # The filter has no false negatives, so if only one
+            # candidate passes it is ours and fs_tx_hash is not needed
+            candidates = self.db.utxo_candidates(tx_hash, idx_packed,
+                                                 candidates)
 
         for hdb_key, hashX in candidates.items():
             tx_num_packed = hdb_key[-TXNUM_LEN:]
@@ -645,11 +877,22 @@ class BlockProcessor:
                 # Remove both entries for this UTXO
                 self.db_deletes.append(hdb_key)
                 self.db_deletes.append(udb_key)
+                self._add_balance_delta(hashX, utxo_value_packed)
                 return hashX + tx_num_packed + utxo_value_packed
 
         raise ChainError(f'UTXO {hash_to_hex_str(tx_hash)} / {tx_idx:,d} not '
                          f'found in "h" table')
 
+    def _add_balance_delta(self, hashX, utxo_value_packed):
+        '''Record the spend of a UTXO in the DB against hashX's balance.'''
+        value, = unpack_le_uint64(utxo_value_packed)
+        delta = self.balance_deltas.get(hashX)
+        if delta is None:
+            self.balance_deltas[hashX] = [-value, -1]
+        else:
+            delta[0] -= value
+            delta[1] -= 1
+
     async def _process_prefetched_blocks(self):
         '''Loop forever processing blocks as they arrive.'''
         while True:
@@ -678,6 +921,39 @@ class BlockProcessor:
         # Reopen for serving
         await self.db.open_for_serving()
 
+    async def compact_history(self):
+        '''Compact the history DB in small passes whilst serving, once its
+        flush count reaches HISTORY_COMPACTION_FLUSH_COUNT.
+
+        Passes hold the state lock so they never overlap a flush, and
+        are paced to take about a tenth of the time.  They pause
+        whilst we are behind the daemon.
+        '''
+        threshold = self.env.history_compaction_flush_count
+        if not threshold:
+            return
+        history = self.db.history
+        limit = 1000 * 1000
+        while True:
+            if history.comp_cursor == -1:
+                if history.flush_count < threshold:
+                    await asyncio.sleep(600)
+                    continue
+                self.logger.info(f'history flush count {history.flush_count:,d}; '
+                                 f'starting online history compaction')
+                await self.run_in_thread_with_lock(history.start_compaction)
+            if self.height < self.daemon.cached_height():
+                await asyncio.sleep(5)
+                continue
+            await self._wait_for_background_flush()
+            start = time.monotonic()
+            await self.run_in_thread_with_lock(self.db.compact_history_pass, limit)
+            elapsed = time.monotonic() - start
+            if history.comp_cursor == -1:
+                self.logger.info(f'online history compaction complete; flush '
+                                 f'count now {history.flush_count:,d}')
+            await asyncio.sleep(max(elapsed * 9, 0.5))
+
     async def _first_open_dbs(self):
         await self.db.open_for_sync()
         self.height = self.db.db_height
@@ -709,6 +985,7 @@ class BlockProcessor:
         except CancelledError:
             self.logger.info('flushing to DB for a clean shutdown...')
             await self.flush(True)
+            await self.run_in_thread_with_lock(self.db.write_utxo_filter)
 
     def force_chain_reorg(self, count):
         '''Force a reorg of the given number of blocks.
@@ -743,14 +1020,14 @@ class NameIndexBlockProcessor(BlockProcessor):
         hashXs_by_tx = []
         append_hashXs = hashXs_by_tx.append
 
-        for tx, _tx_hash in txs:
+        for _tx_hash, _prevouts, outputs in txs:
             hashXs = []
             append_hashX = hashXs.append
 
             # Add the new UTXOs and associate them with the name script
-            for txout in tx.outputs:
+            for pk_script, _value in outputs:
                 # Get the hashX of the name script.  Ignore non-name scripts.
-                hashX = script_name_hashX(txout.pk_script)
+                hashX = script_name_hashX(pk_script)
                 if hashX:
                     append_hashX(hashX)
 
@@ -766,7 +1043,7 @@ class NameIndexBlockProcessor(BlockProcessor):
 class LTORBlockProcessor(BlockProcessor):
 
     def advance_txs(self, txs, is_unspendable):
-        self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
+        self.tx_hashes.append(b''.join(tx_hash for tx_hash, _, _ in txs))
 
         # Use local vars for speed in the loops
         undo_info = []
@@ -782,30 +1059,28 @@ class LTORBlockProcessor(BlockProcessor):
         hashXs_by_tx = [set() for _ in txs]
 
         # Add the new UTXOs
-        for (tx, tx_hash), hashXs in zip(txs, hashXs_by_tx):
+        for (tx_hash, _prevouts, outputs), hashXs in zip(txs, hashXs_by_tx):
             add_hashXs = hashXs.add
             tx_numb = to_le_uint64(tx_num)[:TXNUM_LEN]
 
-            for idx, txout in enumerate(tx.outputs):
+            for idx, (pk_script, value) in enumerate(outputs):
                 # Ignore unspendable outputs
-                if is_unspendable(txout.pk_script):
+                if is_unspendable(pk_script):
                     continue
 
                 # Get the hashX
-                hashX = script_hashX(txout.pk_script)
+                hashX = script_hashX(pk_script)
                 add_hashXs(hashX)
                 put_utxo(tx_hash + to_le_uint32(idx),
-                         hashX + tx_numb + to_le_uint64(txout.value))
+                         hashX + tx_numb + to_le_uint64(value))
             tx_num += 1
 
         # Spend the inputs
         # A separate for-loop here allows any tx ordering in block.
-        for (tx, tx_hash), hashXs in zip(txs, hashXs_by_tx):
+        for (_tx_hash, prevouts, _outputs), hashXs in zip(txs, hashXs_by_tx):
             add_hashXs = hashXs.add
-            for txin in tx.inputs:
-                if txin.is_generation():
-                    continue
-                cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
+            for prev_hash, prev_idx in prevouts:
+                cache_value = spend_utxo(prev_hash, prev_idx)
                 undo_info_append(cache_value)
                 add_hashXs(cache_value[:HASHX_LEN])
 
@@ -836,23 +1111,21 @@ class LTORBlockProcessor(BlockProcessor):
         # Restore coins that had been spent
         # (may include coins made then spent in this block)
         n = 0
-        for tx, tx_hash in txs:
-            for txin in tx.inputs:
-                if txin.is_generation():
-                    continue
+        for _tx_hash, prevouts, _outputs in txs:
+            for prev_hash, prev_idx in prevouts:
                 undo_item = undo_info[n:n + undo_entry_len]
-                put_utxo(txin.prev_hash + pack_le_uint32(txin.prev_idx), undo_item)
+                put_utxo(prev_hash + pack_le_uint32(prev_idx), undo_item)
                 add_touched(undo_item[:HASHX_LEN])
                 n += undo_entry_len
 
         assert n == len(undo_info)
 
         # Remove tx outputs made in this block, by spending them.
-        for tx, tx_hash in txs:
-            for idx, txout in enumerate(tx.outputs):
+        for tx_hash, _prevouts, outputs in txs:
+            for idx, (pk_script, _value) in enumerate(outputs):
                 # Spend the TX outputs.  Be careful with unspendable
                 # outputs - we didn't save those in the first place.
-                if is_unspendable(txout.pk_script):
+                if is_unspendable(pk_script):
                     continue
 
                 # Get the hashX
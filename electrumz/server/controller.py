@@ -10,6 +10,7 @@ from electrumz.lib.util import version_string, OldTaskGroup
 from electrumz.server.db import DB
 from electrumz.server.mempool import MemPool, MemPoolAPI
 from electrumz.server.session import SessionManager
+from electrumz.server.zmq_subscriber import ZMQSubscriber
 
 
 class Notifications:
@@ -52,6 +53,9 @@ class Notifications:
     async def notify(self, height, touched):
         pass
 
+    def block_processed(self):
+        pass
+
     async def start(self, height, notify_func):
         self._highest_block = height
         self.notify = notify_func
@@ -64,6 +68,8 @@ class Notifications:
     async def on_block(self, touched, height):
         self._touched_bp[height] = touched
         self._highest_block = height
+        # The DB is now at the new height, so the mempool can catch up
+        self.block_processed()
         await self._maybe_notify()
 
 
@@ -93,7 +99,8 @@ class Controller(ServerBase):
         Daemon = env.coin.DAEMON
         BlockProcessor = env.coin.BLOCK_PROCESSOR
 
-        async with Daemon(env.coin, env.daemon_url) as daemon:
+        async with Daemon(env.coin, env.daemon_url,
+                          rest_blocks=env.daemon_rest) as daemon:
             db = DB(env)
             bp = BlockProcessor(env, db, daemon, notifications)
 
@@ -111,6 +118,7 @@ class Controller(ServerBase):
                 env.coin, notifications,
                 refresh_secs=env.daemon_poll_interval_mempool_msec/1000,
             )
+            notifications.block_processed = mempool.on_block_processed
 
             session_mgr = SessionManager(env, db, bp, daemon, mempool,
                                          shutdown_event)
@@ -126,8 +134,16 @@ class Controller(ServerBase):
                 await caught_up_event.wait()
                 await group.spawn(db.populate_header_merkle_cache())
                 await group.spawn(mempool.keep_synchronized(mempool_event))
+                await group.spawn(bp.compact_history())
 
             async with OldTaskGroup() as group:
                 await group.spawn(session_mgr.serve(notifications, mempool_event))
                 await group.spawn(bp.fetch_and_process_blocks(caught_up_event))
                 await group.spawn(wait_for_catchup())
+                if env.daemon_zmq_url:
+                    subscriber = ZMQSubscriber(
+                        env.daemon_zmq_url,
+                        on_block=bp.prefetcher.on_block_notification,
+                        on_tx=mempool.on_tx_notification,
+                        on_stop=mempool.on_tx_notifications_stopped)
+                    await group.spawn(subscriber.run())
@@ -45,6 +45,8 @@ class Daemon:
 
     RPC_IN_WARMUP = -28
     RPC_PARSE_ERROR = -32700
+    # Seconds before trying REST again after it fails
+    REST_RETRY_SECS = 600
 
     id_counter = itertools.count()
 
@@ -56,6 +58,7 @@ class Daemon:
             max_workqueue=10,
             init_retry=0.25,
             max_retry=4.0,
+            rest_blocks=False,
     ):
         self.coin = coin
         self.logger = class_logger(__name__, self.__class__.__name__)
@@ -70,6 +73,11 @@ class Daemon:
         self._height = None
         self.available_rpcs = {}
         self.session = None
+        # Opt-in: fetch raw blocks from the daemon's REST interface
+        # (-rest), saving the hex encoding of JSON-RPC, and fall back to
+        # JSON-RPC if it fails
+        self.rest_blocks = rest_blocks
+        self._rest_retry_time = 0
 
         self._networkinfo_cache = (None, 0)
         self._networkinfo_lock = asyncio.Lock()
@@ -246,10 +254,44 @@ class Daemon:
 
     async def raw_blocks(self, hex_hashes):
         '''Return the raw binary blocks with the given hex hashes.'''
-        params_iterable = ((h, False) for h in hex_hashes)
-        blocks = await self._send_vector('getblock', params_iterable)
-        # Convert hex string to bytes
-        return [hex_to_bytes(block) for block in blocks]
+        blocks = await self._rest_raw_blocks(hex_hashes)
+        if blocks is None:
+            params_iterable = ((h, False) for h in hex_hashes)
+            blocks = await self._send_vector('getblock', params_iterable)
+            # Convert hex string to bytes
+            blocks = [hex_to_bytes(block) for block in blocks]
+        return blocks
+
+    async def _rest_raw_block(self, hex_hash):
+        url = f'{self.current_url()}rest/block/{hex_hash}.bin'
+        async with self.workqueue_semaphore:
+            async with self.session.get(url) as resp:
+                if resp.status != 200:
+                    raise ServiceRefusedError(f'HTTP {resp.status} {resp.reason}')
+                if resp.content_length is None:
+                    return await resp.read()
+                # Read the body straight into a buffer of its length
+                return await resp.content.readexactly(resp.content_length)
+
+    async def _rest_raw_blocks(self, hex_hashes):
+        '''Return the raw blocks fetched over REST, or None if REST is
+        disabled or fails.'''
+        if not self.rest_blocks or time.monotonic() < self._rest_retry_time:
+            return None
+        results = await asyncio.gather(
+            *(self._rest_raw_block(hex_hash) for hex_hash in hex_hashes),
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError,
+                                   asyncio.IncompleteReadError,
+                                   ServiceRefusedError)):
+                self._rest_retry_time = time.monotonic() + self.REST_RETRY_SECS
+                self.logger.warning(f'fetching blocks over REST failed: {result}.  '
+                                    f'Using JSON-RPC for {self.REST_RETRY_SECS}s')
+                return None
+            if isinstance(result, BaseException):
+                raise result
+        return results
 
     async def mempool_hashes(self):
         '''Update our record of the daemon's mempool hashes.'''
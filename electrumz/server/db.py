@@ -7,6 +7,7 @@ import ast
 import os
 import time
 from bisect import bisect_right
+from collections import defaultdict
 from dataclasses import dataclass
 from glob import glob
 from typing import Dict, List, Sequence, Tuple, Optional, TYPE_CHECKING
@@ -15,6 +16,7 @@ import attr
 from aiorpcx import run_in_thread, sleep
 
 import electrumz.lib.util as util
+from electrumz.lib.bloom import BloomFilter
 from electrumz.lib.hash import hash_to_hex_str, HASHX_LEN
 from electrumz.lib.merkle import Merkle, MerkleCache
 from electrumz.lib.util import (
@@ -23,9 +25,11 @@ from electrumz.lib.util import (
 )
 from electrumz.server.storage import db_class, Storage
 from electrumz.server.history import History, TXNUM_LEN
+from electrumz.server.segment_log import SegmentLog
 
 if TYPE_CHECKING:
     from electrumz.server.env import Env
+    from electrumz.server.utxo_cache import UTXOCache
 
 
 @dataclass(order=True)
@@ -46,9 +50,13 @@ class FlushData:
     block_tx_hashes = attr.ib()
     # The following are flushed to the UTXO DB if undo_infos is not None
     undo_infos = attr.ib()  # type: List[Tuple[Sequence[bytes], int]]
-    adds = attr.ib()  # type: Dict[bytes, bytes]  # txid+out_idx -> hashX+tx_num+value_sats
+    adds = attr.ib()  # type: UTXOCache  # txid+out_idx -> hashX+tx_num+value_sats
     deletes = attr.ib()  # type: List[bytes]  # b'h' db keys, and b'u' db keys
+    # hashX -> [value_sats, utxo_count] of the UTXOs in deletes, negated
+    balance_deltas = attr.ib()  # type: Dict[bytes, List[int]]
     tip = attr.ib()
+    # History to flush if not the history's own unflushed history
+    unflushed_history = attr.ib(default=None)
 
 
 COMP_TXID_LEN = 4
@@ -61,7 +69,12 @@ class DB:
     it was shutdown uncleanly.
     '''
 
-    DB_VERSIONS = (6, 7, 8)
+    DB_VERSIONS = (6, 7, 8, 9)
+    # Bump when the layout of the 'utxo_filter' file changes
+    UTXO_FILTER_FILE_VERSION = 1
+    # Rebuild the UTXO filter when it holds this many times the keys
+    # of the UTXOs in the DB
+    UTXO_FILTER_MAX_BLOAT = 2
 
     utxo_db: Optional['Storage']
 
@@ -98,8 +111,20 @@ class DB:
         # Key: b'U' + block_height
         # Value: byte-concat list of (hashX + tx_num + value_sats)
         # "undo data: list of UTXOs spent at block height"
+        # Only read now; see undo_log
         self.utxo_db = None
 
+        # Undo data and raw blocks of the last reorg_limit heights
+        self.undo_log = SegmentLog('meta/undo', env.reorg_limit)
+        self.block_log = SegmentLog('meta/blocks', env.reorg_limit)
+
+        # In-memory filter of the UTXOs in the DB, persisted to the
+        # 'utxo_filter' file on a clean close.  Keys are
+        # tx_hash + txout_idx, and tx_hash + txout_idx + tx_num
+        self.utxo_filter = None  # type: Optional[BloomFilter]
+        # The number of UTXOs in the DB whilst there is a filter
+        self.utxo_filter_live = 0
+
         self.utxo_flush_count = 0
         self.fs_height = -1
         self.fs_tx_count = 0
@@ -111,6 +136,9 @@ class DB:
         self.last_flush_tx_count = 0
         self.wall_time = 0
         self.first_sync = True
+        # True if the b'b' balance records are not maintained, as during
+        # the initial sync; rebuild_totals() builds them afresh
+        self.balances_stale = False
         self.db_version = -1
 
         self.logger.info(f'using {self.env.db_engine} for DB backend')
@@ -120,13 +148,13 @@ class DB:
         self.header_mc = MerkleCache(self.merkle, self.fs_block_hashes)
 
         # on-disk: raw block headers in chain order
-        self.headers_file = util.LogicalFile('meta/headers', 2, 16000000)
+        self.headers_file = util.MappedLogicalFile('meta/headers', 2, 16000000)
         # on-disk: cumulative number of txs at the end of height N
-        self.tx_counts_file = util.LogicalFile('meta/txcounts', 2, 2000000)
+        self.tx_counts_file = util.MappedLogicalFile('meta/txcounts', 2, 2000000)
         # on-disk: 32 byte txids in chain order, allows (tx_num -> txid) map
-        self.hashes_file = util.LogicalFile('meta/hashes', 4, 16000000)
+        self.hashes_file = util.MappedLogicalFile('meta/hashes', 4, 16000000)
         if not self.coin.STATIC_BLOCK_HEADERS:
-            self.headers_offsets_file = util.LogicalFile(
+            self.headers_offsets_file = util.MappedLogicalFile(
                 'meta/headers_offsets', 2, 16000000)
 
     async def _read_tx_counts(self):
@@ -160,6 +188,8 @@ class DB:
         else:
             self.logger.info(f'opened UTXO DB (for sync: {for_sync})')
         self.read_utxo_state()
+        self.undo_log.open()
+        self.block_log.open()
 
         # Then history DB
         self.utxo_flush_count = self.history.open_db(self.db_class, for_sync,
@@ -170,6 +200,17 @@ class DB:
         # Read TX counts (requires meta directory)
         await self._read_tx_counts()
 
+        # Balances and history counts are not maintained during the
+        # initial sync; rebuild them once caught up
+        if not self.first_sync and (self.balances_stale
+                                    or self.history.counts_stale):
+            await run_in_thread(self.rebuild_totals)
+
+        # Not maintained during the initial sync; built once caught up
+        if (self.env.utxo_filter and self.utxo_filter is None
+                and not self.first_sync):
+            await run_in_thread(self.open_utxo_filter)
+
     async def open_for_compacting(self):
         await self._open_dbs(True, True)
 
@@ -188,6 +229,7 @@ class DB:
         '''
         if self.utxo_db:
             self.logger.info('closing DBs to re-open for serving')
+            self.write_utxo_filter()
             self.utxo_db.close()
             self.history.close_db()
             self.utxo_db = None
@@ -216,6 +258,7 @@ class DB:
         assert not flush_data.block_tx_hashes
         assert not flush_data.adds
         assert not flush_data.deletes
+        assert not flush_data.balance_deltas
         assert not flush_data.undo_infos
         self.history.assert_flushed()
 
@@ -229,18 +272,23 @@ class DB:
         start_time = time.time()
         prior_flush = self.last_flush
         tx_delta = flush_data.tx_count - self.last_flush_tx_count
+        self.mark_totals_stale()
 
         # Flush to file system
         self.flush_fs(flush_data)
 
         # Then history
-        self.flush_history()
+        self.flush_history(flush_data)
 
         # Flush state last as it reads the wall time.
         with self.utxo_db.write_batch() as batch:
             if flush_utxos:
                 self.flush_utxo_db(batch, flush_data)
             self.flush_state(batch)
+        # Only now are the UTXOs readable from the DB
+        if flush_utxos:
+            flush_data.adds.clear()
+            self.maybe_rebuild_utxo_filter()
 
         # Update and put the wall time again - otherwise we drop the
         # time it took to commit the batch
@@ -268,14 +316,17 @@ class DB:
         The first height to write is self.fs_height + 1.  The FS
         metadata is all append-only, so in a crash we just pick up
         again from the height stored in the DB.
+
+        Blocks above flush_data.height may have been processed since
+        flush_data was taken, so tx_counts can run past it.
         '''
         prior_tx_count = (self.tx_counts[self.fs_height]
                           if self.fs_height >= 0 else 0)
         assert len(flush_data.block_tx_hashes) == len(flush_data.headers)
         assert flush_data.height == self.fs_height + len(flush_data.headers)
-        assert flush_data.tx_count == (self.tx_counts[-1] if self.tx_counts
-                                       else 0)
-        assert len(self.tx_counts) == flush_data.height + 1
+        assert flush_data.tx_count == (self.tx_counts[flush_data.height]
+                                       if flush_data.height >= 0 else 0)
+        assert len(self.tx_counts) >= flush_data.height + 1
         hashes = b''.join(flush_data.block_tx_hashes)
         flush_data.block_tx_hashes.clear()
         assert len(hashes) % 32 == 0
@@ -290,8 +341,8 @@ class DB:
         flush_data.headers.clear()
 
         offset = height_start * self.tx_counts.itemsize
-        self.tx_counts_file.write(offset,
-                                  self.tx_counts[height_start:].tobytes())
+        tx_counts = self.tx_counts[height_start:flush_data.height + 1]
+        self.tx_counts_file.write(offset, tx_counts.tobytes())
         offset = prior_tx_count * 32
         self.hashes_file.write(offset, hashes)
 
@@ -302,8 +353,8 @@ class DB:
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed filesystem data in {elapsed:.2f}s')
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, flush_data):
+        self.history.flush(flush_data.unflushed_history)
 
     def flush_utxo_db(self, batch, flush_data: FlushData):
         '''Flush the cached DB writes and UTXO set to the batch.'''
@@ -322,6 +373,13 @@ class DB:
 
         # New UTXOs
         batch_put = batch.put
+        if self.utxo_filter is not None:
+            self.utxo_filter_live += add_count - spend_count
+            filter_add = self.utxo_filter.add
+            for key, value in flush_data.adds.items():
+                filter_add(key)
+                filter_add(key + value[HASHX_LEN: HASHX_LEN+TXNUM_LEN])
+        balance_deltas = flush_data.balance_deltas
         for key, value in flush_data.adds.items():
             # key: txid+out_idx, value: hashX+tx_num+value_sats
             hashX = value[:HASHX_LEN]
@@ -331,10 +389,18 @@ class DB:
             suffix = txout_idx + tx_num
             batch_put(b'h' + key[:COMP_TXID_LEN] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value_sats)
-        flush_data.adds.clear()
+            delta = balance_deltas.get(hashX)
+            if delta is None:
+                balance_deltas[hashX] = [unpack_le_uint64(value_sats)[0], 1]
+            else:
+                delta[0] += unpack_le_uint64(value_sats)[0]
+                delta[1] += 1
+
+        # Balances of the addresses whose UTXOs changed
+        self.flush_balances(batch, balance_deltas)
 
         # New undo information
-        self.flush_undo_infos(batch_put, flush_data.undo_infos)
+        self.flush_undo_infos(flush_data.undo_infos)
         flush_data.undo_infos.clear()
 
         if self.utxo_db.for_sync:
@@ -351,6 +417,46 @@ class DB:
         self.db_tx_count = flush_data.tx_count
         self.db_tip = flush_data.tip
 
+    def mark_totals_stale(self):
+        '''During the initial sync, stop maintaining the balances and
+        history counts: each costs a point read per touched address on
+        every flush.  They are rebuilt in one pass once caught up.'''
+        if self.first_sync:
+            self.balances_stale = True
+            self.history.counts_stale = True
+
+    def rebuild_totals(self):
+        '''Rebuild the stale balances and history counts.'''
+        self.logger.info('rebuilding the balances and history counts not '
+                         'maintained during the initial sync...')
+        if self.balances_stale:
+            self.build_balances()
+            self.balances_stale = False
+            with self.utxo_db.write_batch() as batch:
+                self.write_utxo_state(batch)
+        if self.history.counts_stale:
+            self.history.rebuild_counts()
+
+    def flush_balances(self, batch, balance_deltas):
+        '''Apply balance_deltas to the balance records and clear it.'''
+        if self.balances_stale:
+            balance_deltas.clear()
+            return
+        # Key: b'b' + address_hashX
+        # Value: confirmed value_sats (8 bytes) + UTXO count (4 bytes)
+        db_get = self.utxo_db.get
+        for hashX, (value, count) in sorted(balance_deltas.items()):
+            key = b'b' + hashX
+            db_value = db_get(key)
+            if db_value:
+                value += unpack_le_uint64(db_value[:8])[0]
+                count += unpack_le_uint32(db_value[8:])[0]
+            if count:
+                batch.put(key, pack_le_uint64(value) + pack_le_uint32(count))
+            else:
+                batch.delete(key)
+        balance_deltas.clear()
+
     def flush_state(self, batch):
         '''Flush chain state to the batch.'''
         now = time.time()
@@ -368,6 +474,7 @@ class DB:
 
         start_time = time.time()
         tx_delta = flush_data.tx_count - self.last_flush_tx_count
+        self.mark_totals_stale()
 
         self.backup_fs(flush_data.height, flush_data.tx_count)
         self.history.backup(touched, flush_data.tx_count)
@@ -375,6 +482,8 @@ class DB:
             self.flush_utxo_db(batch, flush_data)
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
+        flush_data.adds.clear()
+        self.maybe_rebuild_utxo_filter()
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'backup flush #{self.history.flush_count:,d} took '
@@ -452,6 +561,47 @@ class DB:
             tx_hash = self.hashes_file.read(tx_num * 32, 32)
         return tx_hash, tx_height
 
+    def fs_tx_hashes(self, tx_nums):
+        '''Return a list of (tx_hash, tx_height) pairs for the given tx
+        numbers, in the same order.  As for fs_tx_hash() tx_hash is None
+        if the tx_height is not on disk.
+
+        The numbers are resolved in one ascending pass over tx_counts,
+        and hashes of nearby tx numbers are read in a single range.'''
+        tx_counts = self.tx_counts
+        db_height = self.db_height
+        # Allow small gaps in a range rather than start a new one
+        max_gap = 8
+        results = {}
+        run = []
+
+        def read_run():
+            start = run[0]
+            view = self.hashes_file.read_view(start * 32,
+                                              (run[-1] - start + 1) * 32)
+            for tx_num, height in zip(run, run_heights):
+                offset = (tx_num - start) * 32
+                results[tx_num] = (bytes(view[offset: offset + 32]), height)
+            view.release()
+
+        run_heights = []
+        tx_height = 0
+        for tx_num in sorted(set(tx_nums)):
+            tx_height = bisect_right(tx_counts, tx_num, tx_height)
+            if tx_height > db_height:
+                results[tx_num] = (None, tx_height)
+                continue
+            if run and tx_num - run[-1] > max_gap:
+                read_run()
+                run.clear()
+                run_heights.clear()
+            run.append(tx_num)
+            run_heights.append(tx_height)
+        if run:
+            read_run()
+
+        return [results[tx_num] for tx_num in tx_nums]
+
     def fs_tx_hashes_at_blockheight(self, block_height):
         '''Return a list of tx_hashes at given block height,
         in the same order as in the block.
@@ -485,18 +635,58 @@ class DB:
 
         return [self.coin.header_hash(header) for header in headers]
 
-    async def limited_history(self, hashX, *, limit=1000):
+    async def limited_history(self, hashX, *, limit=1000, from_height=0,
+                              to_height=None, reverse=False):
         '''Return an unpruned, sorted list of (tx_hash, height) tuples of
         confirmed transactions that touched the address, earliest in
         the blockchain first.  Includes both spending and receiving
         transactions.  By default returns at most 1000 entries.  Set
         limit to None to get them all.
+
+        Only transactions at heights from from_height, and below
+        to_height if it is not None, are returned.  If reverse the
+        newest are returned first, and reading stops once from_height
+        is reached, which is faster for recent ranges.
         '''
         def read_history():
-            tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
-
+            tx_nums = list(self.history.get_txnums(
+                hashX, limit, reverse=reverse,
+                min_tx_num=self.first_tx_num(from_height),
+                max_tx_num=(None if to_height is None
+                            else self.first_tx_num(to_height))))
+            return self.fs_tx_hashes(tx_nums)
+
+        return await self._read_history(read_history)
+
+    async def history_count(self, hashX):
+        '''Return the number of confirmed transactions that touched the
+        address.'''
+        return await run_in_thread(self.history.get_count, hashX)
+
+    async def history_above(self, hashX, height):
+        '''Return a sorted list of (tx_hash, height) tuples of confirmed
+        transactions that touched the address in blocks above height.
+        '''
+        def read_history():
+            if height >= len(self.tx_counts):
+                return []
+            tx_nums = list(self.history.get_txnums(
+                hashX, None, reverse=True,
+                min_tx_num=self.first_tx_num(height + 1)))
+            tx_nums.reverse()
+            return self.fs_tx_hashes(tx_nums)
+
+        return await self._read_history(read_history)
+
+    def first_tx_num(self, height):
+        '''Return the tx_num of the first transaction at height, or the tx
+        count if height is above the chain tip.'''
+        if height <= 0:
+            return 0
+        tx_counts = self.tx_counts
+        return tx_counts[min(height, len(tx_counts)) - 1]
+
+    async def _read_history(self, read_history):
         while True:
             history = await run_in_thread(read_history)
             if all(hash is not None for hash, height in history):
@@ -517,14 +707,22 @@ class DB:
 
     def read_undo_info(self, height):
         '''Read undo information from a file for the current height.'''
-        return self.utxo_db.get(self.undo_key(height))
+        undo_info = self.undo_log.read(height)
+        if undo_info is None:
+            # Written before the undo log
+            undo_info = self.utxo_db.get(self.undo_key(height))
+        return undo_info
 
     def flush_undo_infos(
-            self, batch_put, undo_infos: Sequence[Tuple[Sequence[bytes], int]]
+            self, undo_infos: Sequence[Tuple[Sequence[bytes], int]]
     ):
-        '''undo_infos is a list of (undo_info, height) pairs.'''
-        for undo_info, height in undo_infos:
-            batch_put(self.undo_key(height), b''.join(undo_info))
+        '''undo_infos is a list of (undo_info, height) pairs.  They are
+        synced to disk as the UTXO state committed after them needs
+        them.'''
+        if undo_infos:
+            for undo_info, height in undo_infos:
+                self.undo_log.write(height, b''.join(undo_info))
+            self.undo_log.sync()
 
     def raw_block_prefix(self):
         return 'meta/block'
@@ -535,22 +733,21 @@ class DB:
     def read_raw_block(self, height):
         '''Returns a raw block read from disk.  Raises FileNotFoundError
         if the block isn't on-disk.'''
+        block = self.block_log.read(height)
+        if block is not None:
+            return block
+        # Written before the block log
         with util.open_file(self.raw_block_path(height)) as f:
             return f.read(-1)
 
     def write_raw_block(self, block, height):
-        '''Write a raw block to disk.'''
-        with util.open_truncate(self.raw_block_path(height)) as f:
-            f.write(block)
-        # Delete old blocks to prevent them accumulating
-        try:
-            del_height = self.min_undo_height(height) - 1
-            os.remove(self.raw_block_path(del_height))
-        except FileNotFoundError:
-            pass
+        '''Write a raw block to disk.  The block log discards old blocks
+        a segment at a time.'''
+        self.block_log.write(height, block)
 
     def clear_excess_undo_info(self):
-        '''Clear excess undo info.  Only most recent N are kept.'''
+        '''Clear excess undo info written before the undo log.  Only most
+        recent N are kept.'''
         prefix = b'U'
         min_height = self.min_undo_height(self.db_height)
         keys = []
@@ -579,6 +776,129 @@ class DB:
                     pass
             self.logger.info(f'deleted {len(paths):,d} stale block files')
 
+    # -- UTXO filter
+
+    def _utxo_filter_tag(self):
+        return repr((self.UTXO_FILTER_FILE_VERSION, BloomFilter.VERSION,
+                     self.db_height, self.db_tip)).encode()
+
+    def _utxo_filter_is_bloated(self):
+        '''Return True if the UTXO filter holds many more keys than the
+        DB has UTXOs, as spent UTXOs are never removed from it.'''
+        live_keys = 2 * max(self.utxo_filter_live, 1_000_000)
+        return self.utxo_filter.count > self.UTXO_FILTER_MAX_BLOAT * live_keys
+
+    def open_utxo_filter(self):
+        '''Load the UTXO filter if it matches the DB state and is not
+        bloated, otherwise rebuild it from the "h" table.'''
+        try:
+            with util.open_file('utxo_filter') as f:
+                data = f.read()
+            tag_len, = unpack_le_uint32(data[:4])
+            if data[4: 4 + tag_len] == self._utxo_filter_tag():
+                cursor = 4 + tag_len
+                self.utxo_filter_live, = unpack_le_uint64(
+                    data[cursor: cursor + 8])
+                self.utxo_filter = BloomFilter.from_bytes(data[cursor + 8:])
+                self.logger.info(f'loaded UTXO filter of '
+                                 f'{self.utxo_filter.count:,d} entries')
+                if not self._utxo_filter_is_bloated():
+                    return
+                self.logger.info('UTXO filter has too many spent UTXOs')
+            else:
+                self.logger.info('UTXO filter is stale')
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self.logger.warning('UTXO filter file is corrupt')
+        self.build_utxo_filter()
+
+    def build_utxo_filter(self):
+        '''Build the UTXO filter from the "h" table.'''
+        self.logger.info('building UTXO filter...')
+        start = time.monotonic()
+        count = sum(1 for _ in self.utxo_db.iterator(prefix=b'h'))
+        utxo_filter = BloomFilter(count * 2)
+        txnum_padding = bytes(8-TXNUM_LEN)
+        for db_key, _hashX in self.utxo_db.iterator(prefix=b'h'):
+            tx_num_packed = db_key[-TXNUM_LEN:]
+            tx_num, = unpack_le_uint64(tx_num_packed + txnum_padding)
+            tx_hash, _height = self.fs_tx_hash(tx_num)
+            key = tx_hash + db_key[-4-TXNUM_LEN:-TXNUM_LEN]
+            utxo_filter.add(key)
+            utxo_filter.add(key + tx_num_packed)
+        self.utxo_filter_live = count
+        self.utxo_filter = utxo_filter
+        self.logger.info(f'built UTXO filter of {count:,d} UTXOs in '
+                         f'{time.monotonic() - start:.1f}s')
+
+    def maybe_rebuild_utxo_filter(self):
+        '''Rebuild the UTXO filter if it is bloated.  Call only once a
+        flush is committed.'''
+        if self.utxo_filter is not None and self._utxo_filter_is_bloated():
+            self.logger.info(f'UTXO filter has {self.utxo_filter.count:,d} '
+                             f'entries for {self.utxo_filter_live:,d} UTXOs')
+            self.build_utxo_filter()
+
+    def write_utxo_filter(self):
+        '''Persist the UTXO filter tagged with the flushed DB state.'''
+        if self.utxo_filter is None:
+            return
+        tag = self._utxo_filter_tag()
+        with util.open_truncate('utxo_filter') as f:
+            f.write(pack_le_uint32(len(tag)) + tag)
+            f.write(pack_le_uint64(self.utxo_filter_live))
+            f.write(self.utxo_filter.to_bytes())
+
+    def read_utxos(self, keys):
+        '''Look up the UTXOs with the given tx_hash + idx_packed keys in
+        the DB.  Returns a dict mapping each key found to a pair
+        (hdb_key, hashX + tx_num + value_sats).
+
+        The "h" and then the "u" table entries are read in key order,
+        which is far cheaper than random seeks once the UTXO set
+        exceeds memory.
+        '''
+        keys_by_prefix = defaultdict(list)
+        for key in keys:
+            keys_by_prefix[b'h' + key[:COMP_TXID_LEN] + key[-4:]].append(key)
+
+        txnum_padding = bytes(8-TXNUM_LEN)
+        found = []
+        for prefix, items in self.utxo_db.seek_prefixes(sorted(keys_by_prefix)):
+            for key in keys_by_prefix[prefix]:
+                candidates = dict(items)
+                if len(candidates) > 1:
+                    candidates = self.utxo_candidates(key[:32], key[-4:],
+                                                      candidates)
+                for hdb_key, hashX in candidates.items():
+                    tx_num_packed = hdb_key[-TXNUM_LEN:]
+                    if len(candidates) > 1:
+                        tx_num, = unpack_le_uint64(tx_num_packed + txnum_padding)
+                        tx_hash, _height = self.fs_tx_hash(tx_num)
+                        if tx_hash != key[:32]:
+                            continue
+                    found.append((b'u' + hashX + hdb_key[-4-TXNUM_LEN:],
+                                  key, hdb_key, hashX + tx_num_packed))
+
+        result = {}
+        db_get = self.utxo_db.get
+        for udb_key, key, hdb_key, prefix in sorted(found):
+            utxo_value_packed = db_get(udb_key)
+            if utxo_value_packed:
+                result[key] = (hdb_key, prefix + utxo_value_packed)
+        return result
+
+    def utxo_candidates(self, tx_hash, idx_packed, candidates):
+        '''Given the "h" table entries for an outpoint, return those that
+        can match tx_hash per the UTXO filter.'''
+        utxo_filter = self.utxo_filter
+        if utxo_filter is None:
+            return candidates
+        key = tx_hash + idx_packed
+        return {db_key: hashX for db_key, hashX in candidates.items()
+                if key + db_key[-TXNUM_LEN:] in utxo_filter}
+
     # -- UTXO database
 
     def read_utxo_state(self):
@@ -591,6 +911,7 @@ class DB:
             self.utxo_flush_count = 0
             self.wall_time = 0
             self.first_sync = True
+            self.balances_stale = False
         else:
             state = ast.literal_eval(state.decode())
             if not isinstance(state, dict):
@@ -613,6 +934,7 @@ class DB:
             self.utxo_flush_count = state['utxo_flush_count']
             self.wall_time = state['wall_time']
             self.first_sync = state['first_sync']
+            self.balances_stale = state.get('balances_stale', False)
 
         # These are our state as we move ahead of DB state
         self.fs_height = self.db_height
@@ -641,6 +963,59 @@ class DB:
         self.logger.info(f'UTXO DB version: {self.db_version}')
         self.logger.info('Upgrading your DB; this can take some time...')
 
+        if self.db_version < 8:
+            self.upgrade_utxo_keys()
+        if self.db_version < 9:
+            self.upgrade_balances()
+
+    def upgrade_balances(self):
+        '''Build the balance records from the b'u' table.'''
+        count = self.build_balances()
+        self.db_version = 9
+        with self.utxo_db.write_batch() as batch:
+            self.write_utxo_state(batch)
+        self.logger.info(f'DB balances of {count:,d} addresses built successfully')
+
+    def build_balances(self):
+        '''Write the balance records afresh from the b'u' table, and
+        delete those of addresses without UTXOs.  Return the number of
+        addresses with UTXOs.'''
+        def build_prefix(prefix):
+            balances = {}
+            hashX = None
+            value = utxo_count = 0
+            # Keys are sorted so each hashX's UTXOs are adjacent
+            for db_key, db_value in self.utxo_db.iterator(prefix=b'u' + prefix):
+                if db_key[1:1+HASHX_LEN] != hashX:
+                    if hashX is not None:
+                        balances[hashX] = (value, utxo_count)
+                    hashX = db_key[1:1+HASHX_LEN]
+                    value = utxo_count = 0
+                value += unpack_le_uint64(db_value)[0]
+                utxo_count += 1
+            if hashX is not None:
+                balances[hashX] = (value, utxo_count)
+            with self.utxo_db.write_batch() as batch:
+                for db_key, _ in self.utxo_db.iterator(prefix=b'b' + prefix):
+                    if db_key[1:] not in balances:
+                        batch.delete(db_key)
+                for hashX, (value, utxo_count) in balances.items():
+                    batch.put(b'b' + hashX, pack_le_uint64(value)
+                              + pack_le_uint32(utxo_count))
+            return len(balances)
+
+        last = time.monotonic()
+        count = 0
+        for cursor in range(65536):
+            count += build_prefix(pack_be_uint16(cursor))
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'DB balances: {count:,d} addresses done, '
+                                 f'{cursor * 100 / 65536:.1f}% complete')
+        return count
+
+    def upgrade_utxo_keys(self):
         def upgrade_u_prefix(prefix):
             count = 0
             with self.utxo_db.write_batch() as batch:
@@ -716,7 +1091,7 @@ class DB:
             tx_counts = array('Q', tx_counts)
             self.tx_counts_file.write(0, tx_counts.tobytes())
 
-        self.db_version = max(self.DB_VERSIONS)
+        self.db_version = 8
         with self.utxo_db.write_batch() as batch:
             self.write_utxo_state(batch)
         self.logger.info('DB 2 of 3 upgraded successfully')
@@ -731,6 +1106,7 @@ class DB:
             'utxo_flush_count': self.utxo_flush_count,
             'wall_time': self.wall_time,
             'first_sync': self.first_sync,
+            'balances_stale': self.balances_stale,
             'db_version': self.db_version,
         }
         batch.put(b'state', repr(state).encode())
@@ -740,11 +1116,27 @@ class DB:
         with self.utxo_db.write_batch() as batch:
             self.write_utxo_state(batch)
 
+    def compact_history_pass(self, limit):
+        '''Run a pass of history compaction whilst serving, writing about
+        limit bytes.  The caller must prevent concurrent flushes.'''
+        history = self.history
+        history._compact_history(limit)
+        if history.comp_cursor == -1:
+            # Complete; as for offline compaction
+            self.set_flush_count(history.flush_count)
+        elif history.comp_flush_count >= history.flush_count:
+            # Keep compacted rows' flush IDs covered by the flush count,
+            # so clear_excess() after an unclean shutdown leaves them
+            history.flush_count = history.comp_flush_count
+            with history.db.write_batch() as batch:
+                history.write_state(batch)
+            self.set_flush_count(history.flush_count)
+
     async def all_utxos(self, hashX):
         '''Return all UTXOs for an address sorted in no particular order.'''
         def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
+            entries = []
+            entries_append = entries.append
             txnum_padding = bytes(8-TXNUM_LEN)
             # Key: b'u' + address_hashX + txout_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
@@ -753,9 +1145,11 @@ class DB:
                 txout_idx, = unpack_le_uint32(db_key[-TXNUM_LEN-4:-TXNUM_LEN])
                 tx_num, = unpack_le_uint64(db_key[-TXNUM_LEN:] + txnum_padding)
                 value, = unpack_le_uint64(db_value)
-                tx_hash, height = self.fs_tx_hash(tx_num)
-                utxos_append(UTXO(tx_num, txout_idx, tx_hash, height, value))
-            return utxos
+                entries_append((tx_num, txout_idx, value))
+            tx_hashes = self.fs_tx_hashes([entry[0] for entry in entries])
+            return [UTXO(tx_num, txout_idx, tx_hash, height, value)
+                    for (tx_num, txout_idx, value), (tx_hash, height)
+                    in zip(entries, tx_hashes)]
 
         while True:
             utxos = await run_in_thread(read_utxos)
@@ -765,6 +1159,19 @@ class DB:
                                 f'found (reorg?), retrying...')
             await sleep(0.25)
 
+    async def get_balance(self, hashX):
+        '''Return a (value_sats, utxo_count) pair of the confirmed UTXOs of
+        an address.'''
+        def read_balance():
+            db_value = self.utxo_db.get(b'b' + hashX)
+            if not db_value:
+                return 0, 0
+            value, = unpack_le_uint64(db_value[:8])
+            count, = unpack_le_uint32(db_value[8:])
+            return value, count
+
+        return await run_in_thread(read_balance)
+
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX,
         value) pair or None if not found.
@@ -779,12 +1186,21 @@ class DB:
                 idx_packed = pack_le_uint32(tx_idx)
                 txnum_padding = bytes(8-TXNUM_LEN)
 
+                # Skip the seek if the filter says there is no such UTXO
+                utxo_filter = self.utxo_filter
+                if (utxo_filter is not None
+                        and tx_hash + idx_packed not in utxo_filter):
+                    return None, None
+
                 # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
                 # Value: hashX
                 prefix = b'h' + tx_hash[:COMP_TXID_LEN] + idx_packed
+                candidates = dict(self.utxo_db.iterator(prefix=prefix))
+                candidates = self.utxo_candidates(tx_hash, idx_packed,
+                                                  candidates)
 
                 # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.utxo_db.iterator(prefix=prefix):
+                for db_key, hashX in candidates.items():
                     tx_num_packed = db_key[-TXNUM_LEN:]
                     tx_num, = unpack_le_uint64(tx_num_packed + txnum_padding)
                     hash, _height = self.fs_tx_hash(tx_num)
@@ -3,6 +3,7 @@
 '''Class for handling environment configuration and defaults.'''
 
 
+import os
 import re
 from ipaddress import IPv4Address, IPv6Address
 from typing import Type
@@ -40,6 +41,9 @@ class Env(EnvBase):
 
         self.db_dir = self.required('DB_DIRECTORY')
         self.daemon_url = self.required('DAEMON_URL')
+        # Off by default as the daemon must be run with -rest
+        self.daemon_rest = self.boolean('DAEMON_REST', False)
+        self.daemon_zmq_url = self.default('DAEMON_ZMQ_URL', None)
         if coin is not None:
             assert issubclass(coin, Coin)
             self.coin = coin
@@ -70,9 +74,18 @@ class Env(EnvBase):
         self.drop_client_unknown = self.boolean('DROP_CLIENT_UNKNOWN', False)
         self.blacklist_url = self.default('BLACKLIST_URL', self.coin.BLACKLIST_URL)
         self.cache_MB = self.integer('CACHE_MB', 1200)
+        self.history_cache_MB = self.integer('HISTORY_CACHE_MB', 64)
+        self.history_compaction_flush_count = self.integer(
+            'HISTORY_COMPACTION_FLUSH_COUNT', 50000)
+        self.compaction_workers = self.integer('COMPACTION_WORKERS',
+                                               min(8, os.cpu_count() or 1))
         self.reorg_limit = self.integer('REORG_LIMIT', self.coin.REORG_LIMIT)
         self.daemon_poll_interval_blocks_msec = self.integer('DAEMON_POLL_INTERVAL_BLOCKS', 5000)
         self.daemon_poll_interval_mempool_msec = self.integer('DAEMON_POLL_INTERVAL_MEMPOOL', 5000)
+        self.utxo_filter = self.boolean('UTXO_FILTER', True)
+        self.block_parse_workers = self.integer('BLOCK_PARSE_WORKERS',
+                                                min(4, os.cpu_count() or 1))
+        self.prefetch_window = self.integer('PREFETCH_WINDOW', 4)
 
         # Server limits to help prevent DoS
 
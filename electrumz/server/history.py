@@ -6,13 +6,17 @@ import ast
 import bisect
 import time
 from array import array
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import accumulate, islice
 from typing import TYPE_CHECKING, Type, Optional
 
 import electrumz.lib.util as util
 from electrumz.lib.hash import HASHX_LEN, hash_to_hex_str
-from electrumz.lib.util import (pack_be_uint16, pack_le_uint64,
-                                unpack_be_uint16_from, unpack_le_uint64)
+from electrumz.lib.util import (pack_be_uint16, pack_le_uint32, pack_le_uint64,
+                                unpack_be_uint16_from, unpack_le_uint32,
+                                unpack_le_uint64)
 
 if TYPE_CHECKING:
     from electrumz.server.storage import Storage
@@ -20,11 +24,89 @@ if TYPE_CHECKING:
 
 TXNUM_LEN = 5
 FLUSHID_LEN = 2
+# Suffix of the key holding the number of history entries of a hashX.
+# Its key length distinguishes it from history rows.
+COUNT_SUFFIX = b'\0\0\0'
+
+
+def encode_txnums(tx_nums):
+    '''Encode a non-empty, sorted sequence of tx_nums as a history row: the
+    first as TXNUM_LEN little-endian bytes, then the differences between
+    successive tx_nums as LEB128 varints.'''
+    row = bytearray(pack_le_uint64(tx_nums[0])[:TXNUM_LEN])
+    append = row.append
+    prior = tx_nums[0]
+    for tx_num in islice(tx_nums, 1, None):
+        delta = tx_num - prior
+        prior = tx_num
+        while delta > 0x7f:
+            append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        append(delta)
+    return bytes(row)
+
+
+def decode_txnums(row):
+    '''Decode a history row written by encode_txnums() to an array('Q').'''
+    first, = unpack_le_uint64(row[:TXNUM_LEN] + bytes(8 - TXNUM_LEN))
+    deltas = row[TXNUM_LEN:]
+    if deltas.isascii():
+        # Every delta is a single byte; the common case for busy addresses
+        return array('Q', accumulate(deltas, initial=first))
+    result = [first]
+    append = result.append
+    tx_num = first
+    value = shift = 0
+    for byte in deltas:
+        if byte < 0x80:
+            tx_num += value | (byte << shift)
+            append(tx_num)
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    return array('Q', result)
+
+
+_VARINT_LAST_BYTES = bytes(range(0x80))
+
+
+def count_txnums(row):
+    '''Return the number of tx_nums in a history row written by
+    encode_txnums() without decoding it: the first, and one per varint,
+    each of which ends with a byte below 0x80.'''
+    deltas = row[TXNUM_LEN:]
+    return 1 + len(deltas) - len(deltas.translate(None, _VARINT_LAST_BYTES))
+
+
+def _decode_raw_txnums(row):
+    '''Decode a history row of fixed-width tx_nums (DB version 2 and below).'''
+    txnum_padding = bytes(8-TXNUM_LEN)
+    return array('Q', b''.join(item + txnum_padding
+                               for item in util.chunks(row, TXNUM_LEN)))
+
+
+def rechunk_txnums(hists, max_row_entries):
+    '''Merge the encoded history rows of a hashX, in order, and re-encode
+    them as rows of up to max_row_entries tx_nums.  Returns a pair
+    (rows, entry count).'''
+    full_hist = array('Q')
+    for hist in hists:
+        full_hist.extend(decode_txnums(hist))
+    rows = [encode_txnums(tx_nums)
+            for tx_nums in util.chunks(full_hist, max_row_entries)]
+    return rows, len(full_hist)
+
+
+def _rechunk_txnums_many(hist_lists, max_row_entries):
+    '''rechunk_txnums() over a list of hashXs' rows; runs in a compaction
+    worker process.'''
+    return [rechunk_txnums(hists, max_row_entries) for hists in hist_lists]
 
 
 class History:
 
-    DB_VERSIONS = (0, 1)
+    DB_VERSIONS = (0, 1, 2, 3)
 
     db: Optional['Storage']
 
@@ -32,16 +114,26 @@ class History:
         self.logger = util.class_logger(__name__, self.__class__.__name__)
         # For history compaction
         self.max_hist_row_entries = 12500
-        self.unflushed = defaultdict(bytearray)
+        self.unflushed = defaultdict(partial(array, 'Q'))
         self.unflushed_count = 0
         self.flush_count = 0
         self.comp_flush_count = -1
         self.comp_cursor = -1
+        # True if the per-hashX counts are not maintained, as during the
+        # initial sync; rebuild_counts() writes them afresh
+        self.counts_stale = False
+        # For compaction whilst serving
+        self.comp_online = False
+        self.comp_dirty = set()
+        self._comp_last_log = 0
         self.db_version = max(self.DB_VERSIONS)
         self.upgrade_cursor = -1
 
         # Key: address_hashX + flush_id
-        # Value: sorted "list" of tx_nums in history of hashX
+        # Value: sorted "list" of tx_nums in history of hashX, encoded
+        #        by encode_txnums()
+        # Key: address_hashX + COUNT_SUFFIX
+        # Value: number of tx_nums in history of hashX as a 32-bit integer
         self.db = None
 
     def open_db(
@@ -55,8 +147,9 @@ class History:
         self.read_state()
         self.clear_excess(utxo_flush_count)
         # An incomplete compaction needs to be cancelled otherwise
-        # restarting it will corrupt the history
-        if not compacting:
+        # restarting it will corrupt the history.  One started online
+        # lost its dirty hashXs so cannot be resumed either.
+        if not compacting or self.comp_online:
             self._cancel_compaction()
         return self.flush_count
 
@@ -74,14 +167,17 @@ class History:
             self.flush_count = state['flush_count']
             self.comp_flush_count = state.get('comp_flush_count', -1)
             self.comp_cursor = state.get('comp_cursor', -1)
+            self.comp_online = state.get('comp_online', False)
             self.db_version = state.get('db_version', 0)
             self.upgrade_cursor = state.get('upgrade_cursor', -1)
+            self.counts_stale = state.get('counts_stale', False)
         else:
             self.flush_count = 0
             self.comp_flush_count = -1
             self.comp_cursor = -1
             self.db_version = max(self.DB_VERSIONS)
             self.upgrade_cursor = -1
+            self.counts_stale = False
 
         if self.db_version not in self.DB_VERSIONS:
             msg = (f'your history DB version is {self.db_version} but '
@@ -103,10 +199,16 @@ class History:
                          'excess history flushes...')
 
         keys = []
-        for key, _hist in self.db.iterator(prefix=b''):
+        removed = defaultdict(int)
+        key_len = HASHX_LEN + FLUSHID_LEN
+        for key, hist in self.db.iterator(prefix=b''):
+            # Ignore non-history entries
+            if len(key) != key_len:
+                continue
             flush_id, = unpack_be_uint16_from(key[-FLUSHID_LEN:])
             if flush_id > utxo_flush_count:
                 keys.append(key)
+                removed[key[:-FLUSHID_LEN]] += len(decode_txnums(hist))
 
         self.logger.info(f'deleting {len(keys):,d} history entries')
 
@@ -114,6 +216,8 @@ class History:
         with self.db.write_batch() as batch:
             for key in keys:
                 batch.delete(key)
+            for hashX in sorted(removed):
+                self._add_count(batch, hashX, -removed[hashX])
             self.write_state(batch)
 
         self.logger.info('deleted excess history entries')
@@ -124,8 +228,10 @@ class History:
             'flush_count': self.flush_count,
             'comp_flush_count': self.comp_flush_count,
             'comp_cursor': self.comp_cursor,
+            'comp_online': self.comp_online,
             'db_version': self.db_version,
             'upgrade_cursor': self.upgrade_cursor,
+            'counts_stale': self.counts_stale,
         }
         # History entries are not prefixed; the suffix \0\0 ensures we
         # look similar to other entries and aren't interfered with
@@ -135,34 +241,51 @@ class History:
         unflushed = self.unflushed
         count = 0
         for tx_num, hashXs in enumerate(hashXs_by_tx, start=first_tx_num):
-            tx_numb = pack_le_uint64(tx_num)[:TXNUM_LEN]
             hashXs = set(hashXs)
             for hashX in hashXs:
-                unflushed[hashX] += tx_numb
+                unflushed[hashX].append(tx_num)
             count += len(hashXs)
         self.unflushed_count += count
 
     def unflushed_memsize(self):
-        return len(self.unflushed) * 180 + self.unflushed_count * TXNUM_LEN
+        return len(self.unflushed) * 180 + self.unflushed_count * 8
 
     def assert_flushed(self):
         assert not self.unflushed
 
-    def flush(self):
+    def take_unflushed(self):
+        '''Return the unflushed history for flushing elsewhere, and start
+        afresh.'''
+        unflushed = self.unflushed
+        self.unflushed = defaultdict(partial(array, 'Q'))
+        self.unflushed_count = 0
+        return unflushed
+
+    def flush(self, unflushed=None):
+        '''Flush unflushed, by default our own unflushed history.'''
         start_time = time.monotonic()
+        if unflushed is None:
+            unflushed = self.unflushed
+            self.unflushed_count = 0
+        if self.comp_cursor != -1:
+            # Keep flush IDs above those of compacted rows, and note
+            # compacted hashXs that need compacting again
+            self.flush_count = max(self.flush_count, self.comp_flush_count)
+            comp_cursor = self.comp_cursor
+            self.comp_dirty.update(hashX for hashX in unflushed
+                                   if unpack_be_uint16_from(hashX)[0] < comp_cursor)
         self.flush_count += 1
         flush_id = pack_be_uint16(self.flush_count)
-        unflushed = self.unflushed
 
         with self.db.write_batch() as batch:
             for hashX in sorted(unflushed):
                 key = hashX + flush_id
-                batch.put(key, bytes(unflushed[hashX]))
+                batch.put(key, encode_txnums(unflushed[hashX]))
+                self._add_count(batch, hashX, len(unflushed[hashX]))
             self.write_state(batch)
 
         count = len(unflushed)
         unflushed.clear()
-        self.unflushed_count = 0
 
         if self.db.for_sync:
             elapsed = time.monotonic() - start_time
@@ -174,23 +297,24 @@ class History:
         self.flush_count += 1
         nremoves = 0
         bisect_left = bisect.bisect_left
-        chunks = util.chunks
 
-        txnum_padding = bytes(8-TXNUM_LEN)
+        key_len = HASHX_LEN + FLUSHID_LEN
         with self.db.write_batch() as batch:
             for hashX in sorted(hashXs):
                 deletes = []
                 puts = {}
+                hashX_removes = 0
                 for key, hist in self.db.iterator(prefix=hashX, reverse=True):
-                    a = array(
-                        'Q',
-                        b''.join(item + txnum_padding for item in chunks(hist, TXNUM_LEN))
-                    )
+                    # Ignore non-history entries
+                    if len(key) != key_len:
+                        continue
+                    a = decode_txnums(hist)
                     # Remove all history entries >= tx_count
                     idx = bisect_left(a, tx_count)
-                    nremoves += len(a) - idx
+                    hashX_removes += len(a) - idx
                     if idx > 0:
-                        puts[key] = hist[:TXNUM_LEN * idx]
+                        if idx < len(a):
+                            puts[key] = encode_txnums(a[:idx])
                         break
                     deletes.append(key)
 
@@ -198,25 +322,124 @@ class History:
                     batch.delete(key)
                 for key, value in puts.items():
                     batch.put(key, value)
+                if hashX_removes:
+                    self._add_count(batch, hashX, -hashX_removes)
+                nremoves += hashX_removes
             self.write_state(batch)
 
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
-    def get_txnums(self, hashX, limit=1000):
+    def get_txnums(self, hashX, limit=1000, *, reverse=False, min_tx_num=0,
+                   max_tx_num=None):
         '''Generator that returns an unpruned, sorted list of tx_nums in the
         history of a hashX.  Includes both spending and receiving
         transactions.  By default yields at most 1000 entries.  Set
-        limit to None to get them all.  '''
+        limit to None to get them all.
+
+        If reverse the newest entries are yielded first.  Only tx_nums
+        at least min_tx_num and, if max_tx_num is not None, below
+        max_tx_num are yielded.  Rows outside those bounds are not
+        decoded, and reverse iteration stops at the first row starting
+        at or below min_tx_num.
+        '''
         limit = util.resolve_limit(limit)
-        chunks = util.chunks
+        for tx_nums in self._txnum_rows(hashX, reverse, min_tx_num, max_tx_num):
+            if reverse:
+                tx_nums = tx_nums[::-1]
+            if 0 <= limit <= len(tx_nums):
+                yield from tx_nums[:limit]
+                return
+            yield from tx_nums
+            limit -= len(tx_nums)
+
+    def _txnum_rows(self, hashX, reverse, min_tx_num, max_tx_num):
+        '''Yield the decoded history rows of hashX in order, clipped to the
+        bounds.'''
+        key_len = HASHX_LEN + FLUSHID_LEN
         txnum_padding = bytes(8-TXNUM_LEN)
-        for _key, hist in self.db.iterator(prefix=hashX):
-            for tx_numb in chunks(hist, TXNUM_LEN):
-                if limit == 0:
+        bisect_left = bisect.bisect_left
+
+        def clip(hist):
+            tx_nums = decode_txnums(hist)
+            start = bisect_left(tx_nums, min_tx_num) if min_tx_num else 0
+            end = (len(tx_nums) if max_tx_num is None
+                   else bisect_left(tx_nums, max_tx_num))
+            return tx_nums[start:end]
+
+        # The first tx_num of each row is stored in full
+        if reverse:
+            for key, hist in self.db.iterator(prefix=hashX, reverse=True):
+                # Ignore non-history entries
+                if len(key) != key_len:
+                    continue
+                first, = unpack_le_uint64(hist[:TXNUM_LEN] + txnum_padding)
+                if max_tx_num is None or first < max_tx_num:
+                    yield clip(hist)
+                if first <= min_tx_num:
                     return
-                tx_num, = unpack_le_uint64(tx_numb + txnum_padding)
-                yield tx_num
-                limit -= 1
+        else:
+            # Hold back each row until the next shows whether it
+            # reaches min_tx_num
+            prior = None
+            for key, hist in self.db.iterator(prefix=hashX):
+                # Ignore non-history entries
+                if len(key) != key_len:
+                    continue
+                first, = unpack_le_uint64(hist[:TXNUM_LEN] + txnum_padding)
+                if prior is not None and first > min_tx_num:
+                    yield clip(prior)
+                if max_tx_num is not None and first >= max_tx_num:
+                    return
+                prior = hist
+            if prior is not None:
+                yield clip(prior)
+
+    def get_count(self, hashX):
+        '''Return the number of tx_nums in the flushed history of a hashX.'''
+        value = self.db.get(hashX + COUNT_SUFFIX)
+        return unpack_le_uint32(value)[0] if value else 0
+
+    def _add_count(self, batch, hashX, delta):
+        if self.counts_stale:
+            return
+        count = self.get_count(hashX) + delta
+        if count:
+            batch.put(hashX + COUNT_SUFFIX, pack_le_uint32(count))
+        else:
+            batch.delete(hashX + COUNT_SUFFIX)
+
+    def rebuild_counts(self):
+        '''Write the history entry count of every hashX afresh, and
+        delete those of hashXs without history.'''
+        key_len = HASHX_LEN + FLUSHID_LEN
+        count_key_len = HASHX_LEN + len(COUNT_SUFFIX)
+        last = time.monotonic()
+        total = 0
+        for cursor in range(65536):
+            counts = defaultdict(int)
+            count_keys = []
+            for key, hist in self.db.iterator(prefix=pack_be_uint16(cursor)):
+                if len(key) == key_len:
+                    counts[key[:-FLUSHID_LEN]] += count_txnums(hist)
+                elif len(key) == count_key_len and key.endswith(COUNT_SUFFIX):
+                    count_keys.append(key)
+            with self.db.write_batch() as batch:
+                for key in count_keys:
+                    if key[:HASHX_LEN] not in counts:
+                        batch.delete(key)
+                for hashX, count in counts.items():
+                    batch.put(hashX + COUNT_SUFFIX, pack_le_uint32(count))
+            total += len(counts)
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'history counts: {total:,d} addresses done, '
+                                 f'{cursor * 100 / 65536:.1f}% complete')
+
+        self.counts_stale = False
+        with self.db.write_batch() as batch:
+            self.write_state(batch)
+        self.logger.info(f'history counts of {total:,d} addresses written')
 
     #
     # History compaction
@@ -236,6 +459,19 @@ class History:
     #
     # When compaction is complete and the final flush takes place,
     # flush_count is reset to comp_flush_count, and comp_flush_count to -1
+    #
+    # Compaction can also run online between history flushes (see
+    # comp_online).  Flushes then keep flush_count at least
+    # comp_flush_count, and record in comp_dirty the hashXs behind
+    # comp_cursor that they write, which are compacted again before
+    # the final flush.
+
+    def start_compaction(self):
+        '''Start compacting the history whilst serving.'''
+        self.comp_cursor = 0
+        self.comp_flush_count = max(self.comp_flush_count, 1)
+        self.comp_online = True
+        self.comp_dirty.clear()
 
     def _flush_compaction(self, cursor, write_items, keys_to_delete):
         '''Flush a single compaction pass as a batch.'''
@@ -244,6 +480,7 @@ class History:
             self.flush_count = self.comp_flush_count
             self.comp_cursor = -1
             self.comp_flush_count = -1
+            self.comp_online = False
         else:
             self.comp_cursor = cursor
 
@@ -260,17 +497,23 @@ class History:
                        write_items, keys_to_delete):
         '''Compres history for a hashX.  hist_list is an ordered list of
         the histories to be compressed.'''
-        # History entries (tx numbers) are TXNUM_LEN bytes each.  Distribute
-        # over rows of up to 50KB in size.  A fixed row size means
-        # future compactions will not need to update the first N - 1
-        # rows.
-        max_row_size = self.max_hist_row_entries * TXNUM_LEN
-        full_hist = b''.join(hist_list)
-        nrows = (len(full_hist) + max_row_size - 1) // max_row_size
+        # Distribute history entries (tx numbers) over rows of up to
+        # max_hist_row_entries entries.  Rows are encoded independently,
+        # so a fixed row length means future compactions will not need
+        # to update the first N - 1 rows.
+        rows, nentries = rechunk_txnums(hist_list, self.max_hist_row_entries)
+        return self._write_compacted(hashX, hist_map, rows, nentries,
+                                     write_items, keys_to_delete)
+
+    def _write_compacted(self, hashX, hist_map, rows, nentries,
+                         write_items, keys_to_delete):
+        '''Queue the writes and deletes replacing a hashX's history rows
+        hist_map with its compacted rows.'''
+        nrows = len(rows)
         if nrows > 4:
             self.logger.info(
                 f'hashX {hash_to_hex_str(hashX)} is large: '
-                f'{len(full_hist) // TXNUM_LEN:,d} entries across {nrows:,d} rows'
+                f'{nentries:,d} entries across {nrows:,d} rows'
             )
 
         # Find what history needs to be written, and what keys need to
@@ -279,7 +522,7 @@ class History:
         # compacted.
         write_size = 0
         keys_to_delete.update(hist_map)
-        for n, chunk in enumerate(util.chunks(full_hist, max_row_size)):
+        for n, chunk in enumerate(rows):
             key = hashX + pack_be_uint16(n)
             if hist_map.get(key) == chunk:
                 keys_to_delete.remove(key)
@@ -287,8 +530,7 @@ class History:
                 write_items.append((key, chunk))
                 write_size += len(chunk)
 
-        assert n + 1 == nrows
-        self.comp_flush_count = max(self.comp_flush_count, n)
+        self.comp_flush_count = max(self.comp_flush_count, nrows - 1)
 
         return write_size
 
@@ -321,6 +563,25 @@ class History:
                                               write_items, keys_to_delete)
         return write_size
 
+    def _compact_dirty(self, write_items, keys_to_delete):
+        '''Compact again the hashXs flushed to after being compacted.'''
+        key_len = HASHX_LEN + FLUSHID_LEN
+        write_size = 0
+        for hashX in sorted(self.comp_dirty):
+            hist_map = {}
+            hist_list = []
+            for key, hist in self.db.iterator(prefix=hashX):
+                # Ignore non-history entries
+                if len(key) != key_len:
+                    continue
+                hist_map[key] = hist
+                hist_list.append(hist)
+            if hist_list:
+                write_size += self._compact_hashX(hashX, hist_map, hist_list,
+                                                  write_items, keys_to_delete)
+        self.comp_dirty.clear()
+        return write_size
+
     def _compact_history(self, limit):
         '''Inner loop of history compaction.  Loops until limit bytes have
         been processed.
@@ -337,22 +598,104 @@ class History:
                                                keys_to_delete)
             cursor += 1
 
+        if cursor == 65536 and self.comp_dirty:
+            write_size += self._compact_dirty(write_items, keys_to_delete)
+
         max_rows = self.comp_flush_count + 1
         self._flush_compaction(cursor, write_items, keys_to_delete)
 
+        # Online passes are small and frequent; log them once a minute
+        now = time.monotonic()
+        if self.comp_online and cursor < 65536 and now < self._comp_last_log + 60:
+            return write_size
+        self._comp_last_log = now
+        self._log_compaction(cursor, write_items, write_size, keys_to_delete,
+                             max_rows)
+        return write_size
+
+    def _read_prefixes(self, start, stop):
+        '''Return (hashX, hist_map) pairs, in key order, of the history
+        rows of the hashXs with 2-byte prefixes in range(start, stop).'''
+        key_len = HASHX_LEN + FLUSHID_LEN
+        hashX_maps = []
+        prior_hashX = None
+        for cursor in range(start, stop):
+            for key, hist in self.db.iterator(prefix=pack_be_uint16(cursor)):
+                # Ignore non-history entries
+                if len(key) != key_len:
+                    continue
+                hashX = key[:-FLUSHID_LEN]
+                if hashX != prior_hashX:
+                    prior_hashX = hashX
+                    hist_map = {}
+                    hashX_maps.append((hashX, hist_map))
+                hist_map[key] = hist
+        return hashX_maps
+
+    def compact_history_parallel(self, limit, workers):
+        '''Compact the history to completion.
+
+        This thread reads ranges of prefixes and hands their rows to
+        worker processes to decode and re-encode, which is where the
+        time goes.  It writes the results in prefix order, flushing
+        when limit bytes are pending, so comp_cursor only passes
+        completed prefixes.  Only this thread touches the DB.
+        '''
+        range_size = 64
+        max_row_entries = self.max_hist_row_entries
+        starts = iter(range(self.comp_cursor, 65536, range_size))
+
+        def submit(start):
+            hashX_maps = self._read_prefixes(start,
+                                             min(start + range_size, 65536))
+            hist_lists = [list(hist_map.values())
+                          for _hashX, hist_map in hashX_maps]
+            return hashX_maps, executor.submit(_rechunk_txnums_many,
+                                               hist_lists, max_row_entries)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque(submit(start)
+                            for start in islice(starts, workers * 2))
+            keys_to_delete = set()
+            write_items = []
+            write_size = 0
+            cursor = self.comp_cursor
+            while pending:
+                hashX_maps, future = pending.popleft()
+                results = future.result()
+                for start in islice(starts, 1):
+                    pending.append(submit(start))
+                for (hashX, hist_map), (rows, nentries) in zip(hashX_maps,
+                                                               results):
+                    write_size += self._write_compacted(
+                        hashX, hist_map, rows, nentries, write_items,
+                        keys_to_delete)
+                cursor = min(cursor + range_size, 65536)
+                if write_size >= limit or cursor == 65536:
+                    max_rows = self.comp_flush_count + 1
+                    self._flush_compaction(cursor, write_items, keys_to_delete)
+                    self._log_compaction(cursor, write_items, write_size,
+                                         keys_to_delete, max_rows)
+                    keys_to_delete = set()
+                    write_items = []
+                    write_size = 0
+
+    def _log_compaction(self, cursor, write_items, write_size, keys_to_delete,
+                        max_rows):
         self.logger.info(
             f'history compaction: wrote {len(write_items):,d} rows '
             f'({write_size / 1000000:.1f} MB), removed '
             f'{len(keys_to_delete):,d} rows, largest: {max_rows:,d}, '
             f'{100 * cursor / 65536:.1f}% complete'
         )
-        return write_size
 
     def _cancel_compaction(self):
         if self.comp_cursor != -1:
             self.logger.warning('cancelling in-progress history compaction')
             self.comp_flush_count = -1
             self.comp_cursor = -1
+            self.comp_online = False
+            self.comp_dirty.clear()
 
     #
     # DB upgrade
@@ -362,6 +705,84 @@ class History:
         self.logger.info(f'history DB version: {self.db_version}')
         self.logger.info('Upgrading your history DB; this can take some time...')
 
+        if self.db_version < 1:
+            self.upgrade_txnum_len()
+        if self.db_version < 2:
+            self.upgrade_counts()
+        if self.db_version < 3:
+            self.upgrade_row_encoding()
+
+    def upgrade_row_encoding(self):
+        '''Rewrite rows of fixed-width tx_nums with encode_txnums().'''
+        def upgrade_cursor(cursor):
+            count = 0
+            prefix = pack_be_uint16(cursor)
+            key_len = HASHX_LEN + FLUSHID_LEN
+            with self.db.write_batch() as batch:
+                batch_put = batch.put
+                for key, hist in self.db.iterator(prefix=prefix):
+                    # Ignore non-history entries
+                    if len(key) != key_len:
+                        continue
+                    count += 1
+                    batch_put(key, encode_txnums(_decode_raw_txnums(hist)))
+                self.upgrade_cursor = cursor
+                self.write_state(batch)
+            return count
+
+        last = time.monotonic()
+        count = 0
+
+        for cursor in range(self.upgrade_cursor + 1, 65536):
+            count += upgrade_cursor(cursor)
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'history DB rows: {count:,d} rows re-encoded, '
+                                 f'{cursor * 100 / 65536:.1f}% complete')
+
+        self.db_version = 3
+        self.upgrade_cursor = -1
+        with self.db.write_batch() as batch:
+            self.write_state(batch)
+        self.logger.info('history DB rows re-encoded successfully')
+
+    def upgrade_counts(self):
+        '''Write the history entry count of every hashX.'''
+        def upgrade_cursor(cursor):
+            prefix = pack_be_uint16(cursor)
+            key_len = HASHX_LEN + FLUSHID_LEN
+            counts = defaultdict(int)
+            for key, hist in self.db.iterator(prefix=prefix):
+                # Ignore non-history entries
+                if len(key) != key_len:
+                    continue
+                counts[key[:-FLUSHID_LEN]] += len(hist) // TXNUM_LEN
+            with self.db.write_batch() as batch:
+                for hashX, count in counts.items():
+                    batch.put(hashX + COUNT_SUFFIX, pack_le_uint32(count))
+                self.upgrade_cursor = cursor
+                self.write_state(batch)
+            return len(counts)
+
+        last = time.monotonic()
+        count = 0
+
+        for cursor in range(self.upgrade_cursor + 1, 65536):
+            count += upgrade_cursor(cursor)
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'history DB counts: {count:,d} addresses done, '
+                                 f'{cursor * 100 / 65536:.1f}% complete')
+
+        self.db_version = 2
+        self.upgrade_cursor = -1
+        with self.db.write_batch() as batch:
+            self.write_state(batch)
+        self.logger.info('history DB counts written successfully')
+
+    def upgrade_txnum_len(self):
         def upgrade_cursor(cursor):
             count = 0
             prefix = pack_be_uint16(cursor)
@@ -391,7 +812,7 @@ class History:
                 self.logger.info(f'DB 3 of 3: {count:,d} entries updated, '
                                  f'{cursor * 100 / 65536:.1f}% complete')
 
-        self.db_version = max(self.DB_VERSIONS)
+        self.db_version = 1
         self.upgrade_cursor = -1
         with self.db.write_batch() as batch:
             self.write_state(batch)
@@ -2,11 +2,12 @@
 
 '''Mempool handling.'''
 
+import asyncio
 import itertools
 import time
 from abc import ABC, abstractmethod
 from asyncio import Lock
-from collections import defaultdict
+from collections import ChainMap, defaultdict
 from typing import Sequence, Tuple, TYPE_CHECKING, Type, Dict, Optional, Set
 import math
 
@@ -108,6 +109,8 @@ class MemPool:
             api: MemPoolAPI,
             *,
             refresh_secs=5.0,
+            min_refresh_secs=1.0,
+            full_refresh_secs=60.0,
             log_status_secs=60.0,
     ):
         assert isinstance(api, MemPoolAPI)
@@ -118,6 +121,18 @@ class MemPool:
         self.hashXs = defaultdict(set)  # None can be a key
         self.cached_compact_histogram = []
         self.refresh_secs = refresh_secs
+        # Announced transactions and processed blocks bring the next
+        # refresh forward, but to no sooner than this after the last
+        self.min_refresh_secs = min(min_refresh_secs, refresh_secs)
+        self.refresh_event = asyncio.Event()
+        # Tx hashes announced by the daemon since the last refresh, or
+        # None if it does not announce them.  When it does, refreshes
+        # only add the announced txs, and the full mempool is fetched
+        # and diffed only on a new height or every full_refresh_secs,
+        # to catch txs evicted by the daemon or announcements missed.
+        # If announcements stop every refresh is a full one again.
+        self.announced = None  # type: Optional[Set[bytes]]
+        self.full_refresh_secs = max(full_refresh_secs, refresh_secs)
         self.log_status_secs = log_status_secs
         # Prevents mempool refreshes during fee histogram calculation
         self.lock = Lock()
@@ -249,47 +264,98 @@ class MemPool:
         # Touched accumulates between calls to on_mempool and each
         # call transfers ownership
         touched = set()
+        # The height and time of the last full refresh
+        full_height = None
+        full_time = 0
         while True:
             height = self.api.cached_height()
-            hex_hashes = await self.api.mempool_hashes()
-            if height != await self.api.height():
-                continue
-            hashes = {hex_str_to_hash(hh) for hh in hex_hashes}
+            start = time.monotonic()
+            full = (self.announced is None or height != full_height
+                    or start >= full_time + self.full_refresh_secs)
+            if self.announced is not None:
+                announced, self.announced = self.announced, set()
+            if full:
+                hex_hashes = await self.api.mempool_hashes()
+                if height != await self.api.height():
+                    continue
+                hashes = {hex_str_to_hash(hh) for hh in hex_hashes}
+                new_hashes = None
+            else:
+                # Txs in a new block are announced too; a new height
+                # means a full refresh instead
+                if height != await self.api.height():
+                    continue
+                hashes = None
+                new_hashes = announced.difference(self.txs)
             try:
                 async with self.lock:
-                    await self._process_mempool(hashes, touched, height)
+                    await self._process_mempool(hashes, touched, height,
+                                                new_hashes)
             except DBSyncError:
                 # The UTXO DB is not at the same height as the
-                # mempool; wait and try again
+                # mempool; try again as soon as the block is processed
                 self.logger.debug('waiting for DB to sync')
+                if new_hashes and self.announced is not None:
+                    self.announced.update(new_hashes)
+                await self._wait_for_db_sync()
+                continue
             else:
+                if full:
+                    full_height = height
+                    full_time = start
                 synchronized_event.set()
                 synchronized_event.clear()
                 await self.api.on_mempool(touched, height)
                 touched = set()
-            await sleep(self.refresh_secs)
-
-    async def _process_mempool(self, all_hashes: Set[bytes], touched, mempool_height):
-        # Re-sync with the new set of hashes
+            await self._wait_for_refresh()
+
+    async def _wait_for_refresh(self):
+        '''Sleep for refresh_secs, or less if a refresh is requested.'''
+        await sleep(self.min_refresh_secs)
+        try:
+            await asyncio.wait_for(self.refresh_event.wait(),
+                           self.refresh_secs - self.min_refresh_secs)
+        except asyncio.TimeoutError:
+            pass
+        self.refresh_event.clear()
+
+    async def _wait_for_db_sync(self):
+        '''Wait for the block processor to process a block, for at most
+        refresh_secs.'''
+        try:
+            await asyncio.wait_for(self.refresh_event.wait(), self.refresh_secs)
+        except asyncio.TimeoutError:
+            pass
+        self.refresh_event.clear()
+
+    async def _process_mempool(self, all_hashes: Optional[Set[bytes]], touched,
+                               mempool_height, new_hashes=None):
+        '''Re-sync with all_hashes, the daemon's full mempool.  Or, if
+        new_hashes is given, just add those transactions.'''
         txs = self.txs
         hashXs = self.hashXs
 
         if mempool_height != self.api.db_height():
             raise DBSyncError
 
-        # First handle txs that have disappeared
-        for tx_hash in (set(txs) - all_hashes):
-            tx = txs.pop(tx_hash)
-            tx_hashXs = {hashX for hashX, value in tx.in_pairs}
-            tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
-            for hashX in tx_hashXs:
-                hashXs[hashX].remove(tx_hash)
-                if not hashXs[hashX]:
-                    del hashXs[hashX]
-            touched |= tx_hashXs
+        if new_hashes is None:
+            # First handle txs that have disappeared
+            for tx_hash in (set(txs) - all_hashes):
+                tx = txs.pop(tx_hash)
+                tx_hashXs = {hashX for hashX, value in tx.in_pairs}
+                tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
+                for hashX in tx_hashXs:
+                    hashXs[hashX].remove(tx_hash)
+                    if not hashXs[hashX]:
+                        del hashXs[hashX]
+                touched |= tx_hashXs
+            new_hashes = all_hashes.difference(txs)
+        else:
+            # Membership of the mempool without copying its hashes
+            all_hashes = ChainMap(txs, dict.fromkeys(new_hashes))
 
         # Process new transactions
-        new_hashes = list(all_hashes.difference(txs))
+        new_hashes = list(new_hashes)
         if new_hashes:
             group = OldTaskGroup()
             for hashes in chunks(new_hashes, 200):
@@ -373,6 +439,23 @@ class MemPool:
     # External interface
     #
 
+    def on_tx_notification(self, tx_hash):
+        '''Called when the daemon announces a transaction.'''
+        if self.announced is None:
+            self.announced = set()
+        self.announced.add(tx_hash)
+        self.refresh_event.set()
+
+    def on_tx_notifications_stopped(self):
+        '''Called when the daemon's transaction announcements stop, so
+        that every refresh is a full one again.'''
+        self.announced = None
+        self.refresh_event.set()
+
+    def on_block_processed(self):
+        '''Called when the block processor has processed a new block.'''
+        self.refresh_event.set()
+
     async def keep_synchronized(self, synchronized_event):
         '''Keep the mempool synchronized with the daemon.'''
         async with OldTaskGroup() as group:
@@ -0,0 +1,140 @@
+'''Append-only segment files of per-height data.'''
+
+import mmap
+import os
+import threading
+
+from electrumz.lib.util import (
+    class_logger, open_file, open_truncate, pack_le_uint32, unpack_le_uint32
+)
+
+
+class SegmentLog:
+    '''Blobs of data for the most recent heights, such as undo information
+    or raw blocks, appended to files of SEGMENT_HEIGHTS heights each.
+
+    Each record is height (4 bytes) + length (4 bytes) + data, and an
+    in-memory index maps heights to their records.  Writing a height
+    drops the records at and above it in its segment, so a chain that
+    is backed up and advanced again overwrites stale records before
+    they can be read.  Segments are deleted whole once they fall below
+    the retained heights rather than a file being created and removed
+    per height.
+    '''
+
+    SEGMENT_HEIGHTS = 100
+    HEADER_LEN = 8
+
+    def __init__(self, dirname, keep):
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.dirname = dirname
+        # The number of heights to retain up to the newest written
+        self.keep = keep
+        # Guards the files and index; on Windows a mapped file cannot be
+        # truncated
+        self.lock = threading.Lock()
+        # height -> (segment, offset, length) of its data
+        self.index = {}
+        # segment -> size of its valid records
+        self.sizes = {}
+        # Segments written since the last sync()
+        self.unsynced = set()
+
+    def _path(self, segment):
+        return os.path.join(self.dirname, f'{segment:d}')
+
+    def open(self):
+        '''Create the directory if necessary and index the segment files.'''
+        os.makedirs(self.dirname, exist_ok=True)
+        with self.lock:
+            self.index.clear()
+            self.sizes.clear()
+            self.unsynced.clear()
+            for name in os.listdir(self.dirname):
+                if name.isdigit():
+                    self._index_segment(int(name))
+
+    def _index_segment(self, segment):
+        header_len = self.HEADER_LEN
+        offset = 0
+        with open_file(self._path(segment)) as f:
+            file_size = f.seek(0, os.SEEK_END)
+            while offset + header_len <= file_size:
+                f.seek(offset)
+                header = f.read(header_len)
+                height, = unpack_le_uint32(header[:4])
+                length, = unpack_le_uint32(header[4:])
+                end = offset + header_len + length
+                if end > file_size or height // self.SEGMENT_HEIGHTS != segment:
+                    break
+                self.index[height] = (segment, offset + header_len, length)
+                offset = end
+            if offset != file_size:
+                # A torn write
+                self.logger.warning(f'truncating {self._path(segment)} from '
+                                    f'{file_size:,d} to {offset:,d} bytes')
+                f.truncate(offset)
+        self.sizes[segment] = offset
+
+    def _remove_segments_below(self, min_segment):
+        for segment in [segment for segment in self.sizes
+                        if segment < min_segment]:
+            del self.sizes[segment]
+            self.unsynced.discard(segment)
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass
+        for height in [height for height, (segment, _, _) in self.index.items()
+                       if segment < min_segment]:
+            del self.index[height]
+
+    def write(self, height, data):
+        '''Write the data for a height, replacing that of it and any
+        higher heights in its segment.'''
+        segment_heights = self.SEGMENT_HEIGHTS
+        segment = height // segment_heights
+        with self.lock:
+            size = self.sizes.get(segment)
+            if size is None:
+                open_truncate(self._path(segment)).close()
+                size = 0
+                min_height = height - self.keep + 1
+                self._remove_segments_below(min_height // segment_heights)
+            else:
+                index = self.index
+                for stale in range(height, (segment + 1) * segment_heights):
+                    entry = index.get(stale)
+                    if entry is not None and entry[0] == segment:
+                        size = min(size, entry[1] - self.HEADER_LEN)
+                        del index[stale]
+
+            with open_file(self._path(segment)) as f:
+                f.seek(size)
+                f.truncate()
+                f.write(pack_le_uint32(height) + pack_le_uint32(len(data)))
+                f.write(data)
+            self.index[height] = (segment, size + self.HEADER_LEN, len(data))
+            self.sizes[segment] = size + self.HEADER_LEN + len(data)
+            self.unsynced.add(segment)
+
+    def sync(self):
+        '''Make the writes so far durable.'''
+        with self.lock:
+            for segment in self.unsynced:
+                with open_file(self._path(segment)) as f:
+                    os.fsync(f.fileno())
+            self.unsynced.clear()
+
+    def read(self, height):
+        '''Return the data at height, or None if there is none.'''
+        with self.lock:
+            entry = self.index.get(height)
+            if entry is None:
+                return None
+            segment, offset, length = entry
+            if not length:
+                return b''
+            with open(self._path(segment), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return m[offset: offset + length]
@@ -4,6 +4,7 @@
 
 import asyncio
 import codecs
+import hashlib
 import itertools
 import math
 import os
@@ -16,8 +17,9 @@ from typing import Optional, TYPE_CHECKING
 import asyncio
 
 import attr
+from aiorpcx import _version as aiorpcx_version
 from aiorpcx import (Event, JSONRPCAutoDetect, JSONRPCConnection,
-                     ReplyAndDisconnect, Request, RPCError, RPCSession,
+                     Notification, ReplyAndDisconnect, Request, RPCError, RPCSession,
                      handler_invocation, serve_rs, serve_ws, sleep,
                      NewlineFramer, TaskTimeout, timeout_after, run_in_thread)
 
@@ -26,7 +28,7 @@ import electrumz.lib.util as util
 from electrumz.lib.lrucache import LRUCache
 from electrumz.lib.util import OldTaskGroup
 from electrumz.lib.hash import (HASHX_LEN, Base58Error, hash_to_hex_str,
-                                hex_str_to_hash, sha256)
+                                hex_str_to_hash)
 from electrumz.lib.merkle import MerkleCache
 from electrumz.lib.text import sessions_lines
 from electrumz.server.daemon import DaemonError
@@ -140,9 +142,25 @@ class SessionManager:
         self.start_time = time.time()
         self._method_counts = defaultdict(int)
         self._reorg_count = 0
-        self._history_cache = LRUCache(maxsize=1000)
+        # Bounded by estimated memory; entries touched by a new block are
+        # marked stale and extended rather than re-read in full
+        self._history_cache = LRUCache(maxsize=env.history_cache_MB * 1_000_000,
+                                       getsizeof=self._history_size)
+        self._history_stale = set()
+        self._history_generation = 0
         self._history_lookups = 0
         self._history_hits = 0
+        self._history_extends = 0
+        # hashX -> (history length, last history entry, sha256 object)
+        self._status_cache = LRUCache(maxsize=20000)
+        # hashX -> set of sessions subscribed to it
+        self._hashX_sessions = {}
+        # Sessions to notify of every new height: those subscribed to
+        # headers, and those with mempool statuses to recheck
+        self._headers_sessions = set()
+        self._mempool_sessions = set()
+        # hashX -> status future, shared by sessions in a notification round
+        self._round_statuses = {}
         self._tx_hashes_cache = LRUCache(maxsize=1000)
         self._tx_hashes_lookups = 0
         self._tx_hashes_hits = 0
@@ -153,6 +171,8 @@ class SessionManager:
         self.estimatefee_cache = LRUCache(maxsize=1000)
         self.notified_height = None
         self.hsub_results = None
+        # JSON RPC protocol class -> serialized headers notification
+        self._hsub_messages = {}
         self._task_group = OldTaskGroup()
         self._sslc = None
         # Event triggered when electrumz is listening for incoming requests.
@@ -273,10 +293,15 @@ class SessionManager:
         '''Clear certain caches on chain reorgs.'''
         while True:
             await self.bp.backed_up_event.wait()
-            self.logger.info(f'reorg signalled; clearing tx_hashes and merkle caches')
+            self.logger.info('reorg signalled; clearing tx_hashes, merkle, '
+                             'history and status caches')
             self._reorg_count += 1
+            self._history_cache.clear()
+            self._history_stale.clear()
+            self._history_generation += 1
             self._tx_hashes_cache.clear()
             self._merkle_cache.clear()
+            self._status_cache.clear()
 
     async def _recalc_concurrency(self):
         '''Periodically recalculate session concurrency.'''
@@ -315,8 +340,12 @@ class SessionManager:
             'db height': self.db.db_height,
             'db_flush_count': self.db.history.flush_count,
             'groups': len(self.session_groups),
-            'history cache': cache_fmt.format(
-                self._history_lookups, self._history_hits, len(self._history_cache)),
+            'history cache': (
+                f'{self._history_lookups:,d} lookups {self._history_hits:,d} hits '
+                f'{self._history_extends:,d} extends '
+                f'{self._history_lookups - self._history_hits - self._history_extends:,d} '
+                f'misses {len(self._history_cache):,d} entries '
+                f'{self._history_cache.currsize:,d} bytes'),
             'merkle cache': cache_fmt.format(
                 self._merkle_lookups, self._merkle_hits, len(self._merkle_cache)),
             'pid': os.getpid(),
@@ -384,8 +413,21 @@ class SessionManager:
         height = min(height, self.db.db_height)
         raw = await self.raw_header(height)
         self.hsub_results = {'hex': raw.hex(), 'height': height}
+        self._hsub_messages = {}
         self.notified_height = height
 
+    def headers_notification_message(self, protocol):
+        '''Return the headers notification message serialized by the JSON RPC
+        protocol class.  It is encoded once per height and shared by all
+        sessions.'''
+        message = self._hsub_messages.get(protocol)
+        if message is None:
+            notification = Notification('blockchain.headers.subscribe',
+                                        (self.hsub_results, ))
+            message = protocol.notification_message(notification)
+            self._hsub_messages[protocol] = message
+        return message
+
     def _session_references(self, items, special_strings):
         '''Return a SessionReferences object.'''
         if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
@@ -790,35 +832,172 @@ class SessionManager:
         limit = self.env.max_send // 99
         cost = 0.1
         self._history_lookups += 1
-        try:
-            result = self._history_cache[hashX]
-            self._history_hits += 1
-        except KeyError:
-            result = await self.db.limited_history(hashX, limit=limit)
-            cost += 0.1 + len(result) * 0.001
-            if len(result) >= limit:
+        generation = self._history_generation
+        result = self._history_cache.get(hashX)
+        if result is None:
+            # The stored count lets us cost and refuse large histories
+            # before reading them
+            count = await self.db.history_count(hashX)
+            cost += 0.1 + min(count, limit) * 0.001
+            if count >= limit:
                 result = RPCError(BAD_REQUEST, f'history too large', cost=cost)
+            else:
+                result = await self.db.limited_history(hashX, limit=limit)
+        elif hashX in self._history_stale and not isinstance(result, Exception):
+            # Histories only grow between reorgs, so read just the new blocks
+            self._history_extends += 1
+            height = result[-1][1] if result else -1
+            new_history = await self.db.history_above(hashX, height)
+            cost += 0.1 + len(new_history) * 0.001
+            result = result + new_history
+        else:
+            self._history_hits += 1
+            if isinstance(result, Exception):
+                raise result
+            return result, cost
+
+        if not isinstance(result, Exception) and len(result) >= limit:
+            result = RPCError(BAD_REQUEST, 'history too large', cost=cost)
+        # Don't cache if a block or reorg arrived whilst reading
+        if generation == self._history_generation:
+            self._history_stale.discard(hashX)
             self._history_cache[hashX] = result
 
         if isinstance(result, Exception):
             raise result
         return result, cost
 
+    @staticmethod
+    def _history_size(result):
+        '''Estimated memory usage of a history cache entry.'''
+        if isinstance(result, Exception):
+            return 500
+        # A list slot, tuple, 32-byte hash and height per entry
+        return 100 + len(result) * 160
+
+    def _mark_history_stale(self, touched):
+        '''Mark cached histories of touched hashXs as needing extension.'''
+        cache = self._history_cache
+        stale = self._history_stale
+        self._history_generation += 1
+        for hashX in touched:
+            if hashX in cache:
+                stale.add(hashX)
+        # Evicted entries are not removed from stale as they go
+        if len(stale) > len(cache):
+            stale.intersection_update(cache)
+
+    def confirmed_status_hasher(self, hashX, db_history):
+        '''Return a pair (hasher, size).  hasher is a sha256 object that
+        has consumed the status string of the confirmed history
+        db_history, and size is the number of bytes newly hashed.
+
+        The hash state is cached per hashX keyed by history length, so
+        when a block extends the history only the new entries are
+        hashed.  The cache is cleared on reorgs.
+        '''
+        count = len(db_history)
+        entry = self._status_cache.get(hashX)
+        if entry and 0 < entry[0] <= count and db_history[entry[0] - 1] == entry[1]:
+            start, hasher = entry[0], entry[2].copy()
+        else:
+            start, hasher = 0, hashlib.sha256()
+        status = ''.join(f'{hash_to_hex_str(tx_hash)}:'
+                         f'{height:d}:'
+                         for tx_hash, height in db_history[start:]).encode()
+        hasher.update(status)
+        if count:
+            self._status_cache[hashX] = (count, db_history[-1], hasher.copy())
+        return hasher, len(status)
+
+    async def address_status(self, hashX):
+        '''Return a (status, cost, in_mempool) tuple for hashX.
+
+        Status is a hex string, but is None if there is no history.
+        '''
+        # Note history is ordered and mempool unordered in electrum-server
+        # For mempool, height is -1 if it has unconfirmed inputs, otherwise 0
+        db_history, cost = await self.limited_history(hashX)
+        mempool = await self.mempool.transaction_summaries(hashX)
+
+        hasher, hashed_len = self.confirmed_status_hasher(hashX, db_history)
+        mempool_status = ''.join(f'{hash_to_hex_str(tx.hash)}:'
+                                 f'{-tx.has_unconfirmed_inputs:d}:'
+                                 for tx in mempool).encode()
+        hasher.update(mempool_status)
+
+        # Add status hashing cost
+        cost += 0.1 + (hashed_len + len(mempool_status)) * 0.00002
+
+        if db_history or mempool:
+            status = hasher.hexdigest()
+        else:
+            status = None
+        return status, cost, bool(mempool)
+
+    async def round_address_status(self, hashX):
+        '''As for address_status, but computed at most once per notification
+        round however many sessions are subscribed to hashX.'''
+        future = self._round_statuses.get(hashX)
+        if future is None:
+            future = asyncio.ensure_future(self.address_status(hashX))
+            self._round_statuses[hashX] = future
+        # Shield so a session timing out does not cancel it for the others
+        return await asyncio.shield(future)
+
+    # Sessions can complete a request after disconnecting; don't index them
+
+    def add_hashX_sub(self, session, hashX):
+        if session in self.sessions:
+            self._hashX_sessions.setdefault(hashX, set()).add(session)
+
+    def set_headers_sub(self, session):
+        if session in self.sessions:
+            self._headers_sessions.add(session)
+
+    def set_mempool_statuses(self, session, has_statuses):
+        if has_statuses and session in self.sessions:
+            self._mempool_sessions.add(session)
+        else:
+            self._mempool_sessions.discard(session)
+
+    def remove_hashX_sub(self, session, hashX):
+        sessions = self._hashX_sessions.get(hashX)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self._hashX_sessions[hashX]
+
     async def _notify_sessions(self, height, touched):
         '''Notify sessions about height changes and touched addresses.'''
         height_changed = height != self.notified_height
         if height_changed:
             await self._refresh_hsub_results(height)
-            # Invalidate our history cache for touched hashXs
-            cache = self._history_cache
-            for hashX in set(cache).intersection(touched):
-                del cache[hashX]
+            self._mark_history_stale(touched)
+
+        # Start a new round of shared statuses and find each session's
+        # touched subscriptions.  Only those sessions, and on a new height
+        # those subscribed to headers or with mempool statuses, need
+        # waking.
+        self._round_statuses = {}
+        session_touched = defaultdict(set)
+        hashX_sessions = self._hashX_sessions
+        for hashX in touched:
+            for session in hashX_sessions.get(hashX, ()):
+                session_touched[session].add(hashX)
+        sessions = set(session_touched)
+        if height_changed:
+            sessions.update(self._headers_sessions)
+            sessions.update(self._mempool_sessions)
 
-        for session in self.sessions:
+        no_touched = frozenset()
+        for session in sessions:
             if self._task_group.joined:  # this can happen during shutdown
                 self.logger.warning(f"task group already terminated. not notifying sessions.")
                 return
-            await self._task_group.spawn(session.notify, touched, height_changed)
+            await self._task_group.spawn(session.notify,
+                                         session_touched.get(session, no_touched),
+                                         height_changed)
 
     def _ip_addr_group_name(self, session) -> Optional[str]:
         host = session.remote_address().host
@@ -859,6 +1038,10 @@ class SessionManager:
         '''Remove a session from our sessions list if there.'''
         self.session_event.set()
         groups = self.sessions.pop(session)
+        for hashX in getattr(session, 'hashX_subs', ()):
+            self.remove_hashX_sub(session, hashX)
+        self._headers_sessions.discard(session)
+        self._mempool_sessions.discard(session)
         for group in groups:
             group.retained_cost += session.cost
             group.sessions.remove(session)
@@ -911,6 +1094,20 @@ class SessionBase(RPCSession):
     async def notify(self, touched, height_changed):
         pass
 
+    async def send_encoded_notification(self, method, args, encode):
+        '''As send_notification(), but encode(protocol) returns the message
+        already serialized by the session's JSON RPC protocol class.
+
+        aiorpcX has no public API to send a pre-encoded message, so this
+        is the one place that uses its internals.  Other versions of
+        aiorpcX encode the message in the usual way.'''
+        protocol = getattr(self.connection, '_protocol', None)
+        if (aiorpcx_version[:2] != (0, 23) or protocol is None
+                or not hasattr(self, '_send_message')):
+            await self.send_notification(method, args)
+            return
+        await self._send_message(encode(protocol))
+
     def default_framer(self):
         return NewlineFramer(max_size=self.env.max_recv)
 
@@ -1039,6 +1236,8 @@ class ElectrumZ(SessionBase):
 
     def unsubscribe_hashX(self, hashX):
         self.mempool_statuses.pop(hashX, None)
+        self.session_mgr.set_mempool_statuses(self, bool(self.mempool_statuses))
+        self.session_mgr.remove_hashX_sub(self, hashX)
         return self.hashX_subs.pop(hashX, None)
 
     async def notify(self, touched, height_changed):
@@ -1054,13 +1253,16 @@ class ElectrumZ(SessionBase):
 
     async def _notify_inner(self, touched, height_changed):
         '''Notify the client about changes to touched addresses (from mempool
-        updates or new blocks) and height.
+        updates or new blocks) and height.  touched holds only hashXs this
+        session is subscribed to.
         '''
         if height_changed and self.subscribe_headers:
-            args = (await self.subscribe_headers_result(), )
-            await self.send_notification('blockchain.headers.subscribe', args)
+            # Encoded once per height rather than for every session
+            session_mgr = self.session_mgr
+            await self.send_encoded_notification(
+                'blockchain.headers.subscribe', (session_mgr.hsub_results, ),
+                session_mgr.headers_notification_message)
 
-        touched = touched.intersection(self.hashX_subs)
         if touched or (height_changed and self.mempool_statuses):
             changed = {}
 
@@ -1095,6 +1297,7 @@ class ElectrumZ(SessionBase):
     async def headers_subscribe(self):
         '''Subscribe to get raw headers of new blocks.'''
         self.subscribe_headers = True
+        self.session_mgr.set_headers_sub(self)
         self.bump_cost(0.25)
         return await self.subscribe_headers_result()
 
@@ -1109,43 +1312,29 @@ class ElectrumZ(SessionBase):
         self.bump_cost(1.0)
         return self.peer_mgr.on_peers_subscribe(self.is_tor())
 
+    def _record_status(self, hashX, status, cost, in_mempool):
+        self.bump_cost(cost)
+        if in_mempool:
+            self.mempool_statuses[hashX] = status
+        else:
+            self.mempool_statuses.pop(hashX, None)
+        self.session_mgr.set_mempool_statuses(self, bool(self.mempool_statuses))
+        return status
+
     async def address_status(self, hashX):
         '''Returns an address status.
 
         Status is a hex string, but must be None if there is no history.
         '''
-        # Note history is ordered and mempool unordered in electrum-server
-        # For mempool, height is -1 if it has unconfirmed inputs, otherwise 0
-        db_history, cost = await self.session_mgr.limited_history(hashX)
-        mempool = await self.mempool.transaction_summaries(hashX)
-
-        status = ''.join(f'{hash_to_hex_str(tx_hash)}:'
-                         f'{height:d}:'
-                         for tx_hash, height in db_history)
-        status += ''.join(f'{hash_to_hex_str(tx.hash)}:'
-                          f'{-tx.has_unconfirmed_inputs:d}:'
-                          for tx in mempool)
-
-        # Add status hashing cost
-        self.bump_cost(cost + 0.1 + len(status) * 0.00002)
-
-        if status:
-            status = sha256(status.encode()).hex()
-        else:
-            status = None
-
-        if mempool:
-            self.mempool_statuses[hashX] = status
-        else:
-            self.mempool_statuses.pop(hashX, None)
-
-        return status
+        return self._record_status(hashX, *await self.session_mgr.address_status(hashX))
 
     async def subscription_address_status(self, hashX):
         '''As for address_status, but if it can't be calculated the subscription is
-        discarded.'''
+        discarded.  The status is shared with other sessions notified in the
+        same round.'''
         try:
-            return await self.address_status(hashX)
+            result = await self.session_mgr.round_address_status(hashX)
+            return self._record_status(hashX, *result)
         except RPCError:
             self.unsubscribe_hashX(hashX)
             return None
@@ -1169,13 +1358,13 @@ class ElectrumZ(SessionBase):
         # Store the subscription only after address_status succeeds
         result = await self.address_status(hashX)
         self.hashX_subs[hashX] = alias
+        self.session_mgr.add_hashX_sub(self, hashX)
         return result
 
     async def get_balance(self, hashX):
-        utxos = await self.db.all_utxos(hashX)
-        confirmed = sum(utxo.value for utxo in utxos)
+        confirmed, _utxo_count = await self.db.get_balance(hashX)
         unconfirmed = await self.mempool.balance_delta(hashX)
-        self.bump_cost(1.0 + len(utxos) / 50)
+        self.bump_cost(1.0)
         return {'confirmed': confirmed, 'unconfirmed': unconfirmed}
 
     async def scripthash_get_balance(self, scripthash):
@@ -1201,10 +1390,43 @@ class ElectrumZ(SessionBase):
                 for tx_hash, height in history]
         return conf + await self.unconfirmed_history(hashX)
 
-    async def scripthash_get_history(self, scripthash):
-        '''Return the confirmed and unconfirmed history of a scripthash.'''
+    async def history_page(self, hashX, from_height, to_height):
+        '''The confirmed history between from_height and to_height (exclusive;
+        -1 for no limit), followed by the unconfirmed history if to_height
+        is -1.'''
+        limit = self.env.max_send // 99
+        # Read newest first when the range is recent; there are fewer rows
+        # to walk from the end
+        reverse = from_height > self.db.db_height // 2
+        history = await self.db.limited_history(
+            hashX, limit=limit, from_height=from_height,
+            to_height=None if to_height == -1 else to_height, reverse=reverse)
+        self.bump_cost(0.2 + len(history) * 0.001)
+        if len(history) >= limit:
+            raise RPCError(BAD_REQUEST, 'history too large; request a smaller '
+                           'height range')
+        if reverse:
+            history.reverse()
+        conf = [{'tx_hash': hash_to_hex_str(tx_hash), 'height': height}
+                for tx_hash, height in history]
+        if to_height == -1:
+            conf += await self.unconfirmed_history(hashX)
+        return conf
+
+    async def scripthash_get_history(self, scripthash, from_height=0, to_height=-1):
+        '''Return the confirmed and unconfirmed history of a scripthash.
+
+        from_height: only transactions at or above this height
+        to_height: only transactions below this height; -1 means no limit
+                   and includes unconfirmed transactions
+        '''
         hashX = scripthash_to_hashX(scripthash)
-        return await self.confirmed_and_unconfirmed_history(hashX)
+        from_height = non_negative_integer(from_height)
+        if to_height != -1:
+            to_height = non_negative_integer(to_height)
+        if from_height == 0 and to_height == -1:
+            return await self.confirmed_and_unconfirmed_history(hashX)
+        return await self.history_page(hashX, from_height, to_height)
 
     async def scripthash_get_mempool(self, scripthash):
         '''Return the mempool transactions touching a scripthash.'''
@@ -62,6 +62,28 @@ class Storage:
         reverse order.
         '''
         raise NotImplementedError
+
+    def seek_prefixes(self, prefixes):
+        '''For each of the sorted `prefixes` yield a pair (prefix, items)
+        where items is a list of the (key, value) pairs with that
+        prefix.
+
+        Engines that can re-seek an iterator sweep a single iterator
+        forwards through the keys.
+        '''
+        for prefix in prefixes:
+            yield prefix, list(self.iterator(prefix=prefix))
+
+    @staticmethod
+    def _sweep(iterator, prefixes):
+        for prefix in prefixes:
+            iterator.seek(prefix)
+            items = []
+            for key, value in iterator:
+                if not key.startswith(prefix):
+                    break
+                items.append((key, value))
+            yield prefix, items
     
 
 
@@ -74,10 +96,16 @@ class LevelDB(Storage):
         cls.module = plyvel
 
     def open(self, name, create):
-        mof = 512 if self.for_sync else 128
+        if self.for_sync:
+            # Bulk loading: large memtables and table files mean far
+            # fewer level-0 files and much less compaction work
+            options = dict(max_open_files=512,
+                           write_buffer_size=128 * 1024 * 1024,
+                           max_file_size=32 * 1024 * 1024)
+        else:
+            options = dict(max_open_files=128)
         # Use snappy compression (the default)
-        self.db = self.module.DB(name, create_if_missing=create,
-                                 max_open_files=mof)
+        self.db = self.module.DB(name, create_if_missing=create, **options)
         self.close = self.db.close
         self.get = self.db.get
         self.put = self.db.put
@@ -85,6 +113,10 @@ class LevelDB(Storage):
         self.write_batch = partial(self.db.write_batch, transaction=True,
                                    sync=True)
 
+    def seek_prefixes(self, prefixes):
+        with self.db.iterator() as iterator:
+            yield from self._sweep(iterator, prefixes)
+
 
 
 class RocksDB(Storage):
@@ -96,12 +128,24 @@ class RocksDB(Storage):
         cls.module = rocksdb
 
     def open(self, name, create):
-        mof = 512 if self.for_sync else 128
         # Use snappy compression (the default)
         options = self.module.Options(create_if_missing=create,
                                       use_fsync=True,
                                       target_file_size_base=33554432,
-                                      max_open_files=mof)
+                                      max_open_files=128)
+        if self.for_sync:
+            # Bulk loading: buffer more in memory and let level 0 grow
+            # before compacting, trading read amplification for much
+            # less write amplification
+            options.max_open_files = 512
+            options.write_buffer_size = 128 * 1024 * 1024
+            options.max_write_buffer_number = 4
+            options.min_write_buffer_number_to_merge = 2
+            options.level0_file_num_compaction_trigger = 8
+            options.level0_slowdown_writes_trigger = 32
+            options.level0_stop_writes_trigger = 48
+            options.target_file_size_base = 128 * 1024 * 1024
+            options.max_bytes_for_level_base = 1024 * 1024 * 1024
         self.db = self.module.DB(name, options)
         self.get = self.db.get
         self.put = self.db.put
@@ -118,6 +162,9 @@ class RocksDB(Storage):
     def iterator(self, prefix=b'', reverse=False):
         return RocksDBIterator(self.db, prefix, reverse)
 
+    def seek_prefixes(self, prefixes):
+        return self._sweep(self.db.iteritems(), prefixes)
+
 
 class RocksDBWriteBatch:
     '''A write batch for RocksDB.'''
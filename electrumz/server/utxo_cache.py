@@ -0,0 +1,174 @@
+'''Compact in-memory UTXO cache.'''
+
+from array import array
+
+from electrumz.lib.hash import HASHX_LEN
+from electrumz.server.history import TXNUM_LEN
+
+
+class UTXOCache:
+    '''A hash table mapping TX_HASH + TX_IDX to HASHX + TX_NUM + VALUE.
+
+    Each entry's key and value are stored together as a fixed-width
+    record in one bytearray, and an open-addressing index of two
+    arrays holds each slot's record number and key hash.  There are no
+    per-entry Python objects, so an entry costs its 60-byte record
+    plus 12 bytes per index slot: about 80 to 110 bytes against about
+    160 to 205 in a dict of bytes objects.  Supports the subset of the
+    dict interface used by the block processor and the DB flush.
+    '''
+
+    KEY_LEN = 32 + 4
+    VALUE_LEN = HASHX_LEN + TXNUM_LEN + 8
+    RECORD_LEN = KEY_LEN + VALUE_LEN
+    MIN_SLOTS = 1 << 16
+    # Index slots in use, including deleted ones, before rehashing
+    MAX_LOAD = 0.7
+    # Index slot record numbers
+    EMPTY = -1
+    DELETED = -2
+
+    def __init__(self):
+        self._reset(self.MIN_SLOTS)
+
+    def _reset(self, nslots):
+        # Record number of each index slot, and the hash of its key
+        self._slots = array('i', [self.EMPTY]) * nslots
+        self._hashes = array('q', [0]) * nslots
+        self._mask = nslots - 1
+        self._limit = int(nslots * self.MAX_LOAD)
+        self._records = bytearray()
+        # Record numbers of popped entries, for reuse
+        self._free = array('i')
+        # Live entries, and live entries plus deleted slots
+        self._count = 0
+        self._used = 0
+
+    def _find(self, key, key_hash):
+        '''Return the index slot of key, or -1.'''
+        slots = self._slots
+        hashes = self._hashes
+        records = self._records
+        mask = self._mask
+        record_len = self.RECORD_LEN
+        key_len = self.KEY_LEN
+        slot = key_hash & mask
+        while True:
+            record = slots[slot]
+            if record >= 0:
+                if hashes[slot] == key_hash:
+                    offset = record * record_len
+                    if records[offset: offset + key_len] == key:
+                        return slot
+            elif record == -1:
+                return -1
+            slot = (slot + 1) & mask
+
+    def _rehash(self):
+        '''Drop the deleted slots, growing the index if more than half
+        full of live entries.'''
+        old_slots = self._slots
+        old_hashes = self._hashes
+        nslots = len(old_slots)
+        while self._count * 2 > nslots:
+            nslots *= 2
+        slots = array('i', [self.EMPTY]) * nslots
+        hashes = array('q', [0]) * nslots
+        mask = nslots - 1
+        for old_slot, record in enumerate(old_slots):
+            if record >= 0:
+                key_hash = old_hashes[old_slot]
+                slot = key_hash & mask
+                while slots[slot] != -1:
+                    slot = (slot + 1) & mask
+                slots[slot] = record
+                hashes[slot] = key_hash
+        self._slots = slots
+        self._hashes = hashes
+        self._mask = mask
+        self._limit = int(nslots * self.MAX_LOAD)
+        self._used = self._count
+
+    def __setitem__(self, key, value):
+        assert len(value) == self.VALUE_LEN
+        key_hash = hash(key)
+        slot = self._find(key, key_hash)
+        records = self._records
+        if slot >= 0:
+            offset = self._slots[slot] * self.RECORD_LEN + self.KEY_LEN
+            records[offset: offset + self.VALUE_LEN] = value
+            return
+
+        if self._used >= self._limit:
+            self._rehash()
+        free = self._free
+        if free:
+            record = free.pop()
+            offset = record * self.RECORD_LEN
+            records[offset: offset + self.RECORD_LEN] = key + value
+        else:
+            record = len(records) // self.RECORD_LEN
+            records += key
+            records += value
+
+        # Use the first deleted or empty slot
+        slots = self._slots
+        mask = self._mask
+        slot = key_hash & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        if slots[slot] == -1:
+            self._used += 1
+        slots[slot] = record
+        self._hashes[slot] = key_hash
+        self._count += 1
+
+    def get(self, key, default=None):
+        slot = self._find(key, hash(key))
+        if slot < 0:
+            return default
+        offset = self._slots[slot] * self.RECORD_LEN + self.KEY_LEN
+        return bytes(self._records[offset: offset + self.VALUE_LEN])
+
+    def pop(self, key, default=None):
+        slot = self._find(key, hash(key))
+        if slot < 0:
+            return default
+        slots = self._slots
+        record = slots[slot]
+        offset = record * self.RECORD_LEN + self.KEY_LEN
+        value = bytes(self._records[offset: offset + self.VALUE_LEN])
+        slots[slot] = self.DELETED
+        self._free.append(record)
+        self._count -= 1
+        return value
+
+    def __contains__(self, key):
+        return self._find(key, hash(key)) >= 0
+
+    def __len__(self):
+        return self._count
+
+    def items(self):
+        '''Yield (key, value) pairs in no particular order.'''
+        records = self._records
+        record_len = self.RECORD_LEN
+        key_len = self.KEY_LEN
+        for record in self._slots:
+            if record >= 0:
+                offset = record * record_len
+                yield (bytes(records[offset: offset + key_len]),
+                       bytes(records[offset + key_len: offset + record_len]))
+
+    def clear(self):
+        # Start the index at half the size it grew to, so a cache that
+        # refills after a flush rehashes less often
+        nslots = self.MIN_SLOTS
+        while nslots * self.MAX_LOAD < self._count // 2:
+            nslots *= 2
+        self._reset(nslots)
+
+    def memsize(self):
+        '''Bytes of memory allocated to the table.'''
+        return (self._slots.__sizeof__() + self._hashes.__sizeof__()
+                + self._records.__sizeof__() + self._free.__sizeof__())
@@ -0,0 +1,67 @@
+'''Subscriber to the daemon's ZMQ notifications.'''
+
+from electrumz.lib.util import class_logger
+
+
+class ZMQSubscriber:
+    '''Receives the daemon's hashblock and hashtx ZMQ notifications and
+    passes them on, so new blocks and mempool transactions are noticed
+    without waiting for the next poll.
+
+    urls is a comma-separated list of ZMQ endpoints, such as the
+    daemon's -zmqpubhashblock and -zmqpubhashtx addresses.  Requires
+    pyzmq; without it, or if the daemon is silent, polling carries on
+    as before.
+    '''
+
+    TOPICS = (b'hashblock', b'hashtx')
+
+    def __init__(self, urls, *, on_block, on_tx, on_stop=None):
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.urls = [url.strip() for url in urls.split(',') if url.strip()]
+        # Called with no arguments
+        self.on_block = on_block
+        # Called with a tx hash in internal byte order
+        self.on_tx = on_tx
+        # Called with no arguments once the subscription ends
+        self.on_stop = on_stop
+        self.block_count = 0
+        self.tx_count = 0
+
+    async def run(self):
+        try:
+            import zmq
+            import zmq.asyncio
+        except ImportError:
+            self.logger.error('DAEMON_ZMQ_URL is set but pyzmq is not '
+                              'installed; polling the daemon only')
+            return
+
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.SUB)
+        try:
+            # Never drop notifications for want of a buffer
+            socket.setsockopt(zmq.RCVHWM, 0)
+            for topic in self.TOPICS:
+                socket.setsockopt(zmq.SUBSCRIBE, topic)
+            for url in self.urls:
+                socket.connect(url)
+            self.logger.info(f'subscribed to {", ".join(self.urls)}')
+            while True:
+                parts = await socket.recv_multipart()
+                topic, body = parts[0], parts[1]
+                if topic == b'hashblock':
+                    self.block_count += 1
+                    self.on_block()
+                elif topic == b'hashtx' and len(body) == 32:
+                    self.tx_count += 1
+                    # Sent in display order
+                    self.on_tx(body[::-1])
+        except zmq.ZMQError as e:
+            self.logger.error(f'ZMQ subscription failed: {e}; polling the '
+                              f'daemon only')
+        finally:
+            socket.close(linger=0)
+            context.term()
+            if self.on_stop:
+                self.on_stop()
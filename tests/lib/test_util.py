@@ -0,0 +1,35 @@
+import mmap
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('aiorpcx')
+
+from electrumz.lib import util
+
+
+def test_mapped_logical_file_write_during_map(tmp_path, monkeypatch):
+    '''A write that lands whilst a reader is mapping the segment must
+    not leave the reader's shorter mapping in place.'''
+    monkeypatch.chdir(tmp_path)
+    f = util.MappedLogicalFile('seg', 2, 1 << 20)
+    f.write(0, b'a' * 64)
+    real_mmap = mmap.mmap
+    writers = []
+
+    def slow_mmap(*args, **kwargs):
+        segment = real_mmap(*args, **kwargs)
+        if not writers:
+            # Append whilst the old size is being mapped
+            writer = threading.Thread(target=f.write, args=(64, b'b' * 32))
+            writers.append(writer)
+            writer.start()
+            time.sleep(0.2)
+        return segment
+
+    monkeypatch.setattr(util.mmap, 'mmap', slow_mmap)
+    assert f.read(0, 64) == b'a' * 64
+    writers[0].join()
+    assert f.read(64, 32) == b'b' * 32
+    assert bytes(f.read_view(64, 32)) == b'b' * 32
@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import pytest
+
+web = pytest.importorskip('aiohttp.web')
+pytest.importorskip('aiorpcx')
+
+from electrumz.lib.coins import BitcoinZ
+from electrumz.server.daemon import Daemon
+
+
+BLOCKS = {
+    '11' * 32: bytes(range(200)),
+    '22' * 32: b'\xab' * 5000,
+}
+
+
+class FakeDaemon:
+    '''A daemon answering getblock over JSON-RPC and, if rest is true,
+    serving raw blocks over REST.'''
+
+    def __init__(self, rest):
+        self.rest = rest
+        self.rest_requests = 0
+        self.rpc_requests = 0
+        self.app = web.Application()
+        self.app.router.add_post('/', self.rpc)
+        self.app.router.add_get('/rest/block/{hex_hash}.bin', self.rest_block)
+
+    async def rpc(self, request):
+        self.rpc_requests += 1
+        payload = await request.json()
+        assert all(item['method'] == 'getblock' for item in payload)
+        result = [{'result': BLOCKS[item['params'][0]].hex(), 'error': None,
+                   'id': item['id']} for item in payload]
+        # Without a charset, as the daemon sends it
+        return web.Response(body=json.dumps(result).encode(),
+                            content_type='application/json')
+
+    async def rest_block(self, request):
+        self.rest_requests += 1
+        if not self.rest:
+            raise web.HTTPNotFound()
+        return web.Response(body=BLOCKS[request.match_info['hex_hash']],
+                            content_type='application/octet-stream')
+
+
+def fetch_blocks(rest_blocks, rest_served, calls=1):
+    '''Fetch BLOCKS calls times from a FakeDaemon; return the last
+    result and the FakeDaemon.'''
+    fake = FakeDaemon(rest_served)
+
+    async def run():
+        runner = web.AppRunner(fake.app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            async with Daemon(BitcoinZ, f'user:pass@127.0.0.1:{port}',
+                              rest_blocks=rest_blocks) as daemon:
+                for _ in range(calls):
+                    blocks = await daemon.raw_blocks(list(BLOCKS))
+            return blocks
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run()), fake
+
+
+def test_raw_blocks_rpc():
+    blocks, fake = fetch_blocks(False, True)
+    assert blocks == list(BLOCKS.values())
+    assert fake.rest_requests == 0
+    assert fake.rpc_requests == 1
+
+
+def test_raw_blocks_rest():
+    blocks, fake = fetch_blocks(True, True)
+    assert blocks == list(BLOCKS.values())
+    assert fake.rest_requests == len(BLOCKS)
+    assert fake.rpc_requests == 0
+
+
+def test_raw_blocks_rest_fallback():
+    blocks, fake = fetch_blocks(True, False, calls=2)
+    assert blocks == list(BLOCKS.values())
+    # REST is not retried straight after failing
+    assert fake.rest_requests == len(BLOCKS)
+    assert fake.rpc_requests == 2
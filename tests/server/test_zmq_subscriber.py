@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+zmq = pytest.importorskip('zmq')
+pytest.importorskip('zmq.asyncio')
+
+from electrumz.server.zmq_subscriber import ZMQSubscriber
+
+
+def test_subscriber_callbacks():
+    tx_hash = bytes(range(32))
+    blocks = []
+    txs = []
+
+    async def run():
+        context = zmq.asyncio.Context()
+        publisher = context.socket(zmq.PUB)
+        port = publisher.bind_to_random_port('tcp://127.0.0.1')
+        subscriber = ZMQSubscriber(f'tcp://127.0.0.1:{port}',
+                                   on_block=lambda: blocks.append(True),
+                                   on_tx=txs.append)
+        task = asyncio.ensure_future(subscriber.run())
+        try:
+            # Publish until the subscription is established
+            for _ in range(200):
+                await publisher.send_multipart([b'hashblock', bytes(32),
+                                                b'\0\0\0\0'])
+                await publisher.send_multipart([b'hashtx', tx_hash[::-1],
+                                                b'\0\0\0\0'])
+                # Not subscribed to
+                await publisher.send_multipart([b'rawtx', b'raw',
+                                                b'\0\0\0\0'])
+                await asyncio.sleep(0.01)
+                if blocks and txs:
+                    break
+        finally:
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            publisher.close(linger=0)
+            context.term()
+        return subscriber
+
+    subscriber = asyncio.run(run())
+    assert blocks and subscriber.block_count == len(blocks)
+    assert txs and subscriber.tx_count == len(txs)
+    # Passed on in internal byte order
+    assert set(txs) == {tx_hash}
+
+
+def test_subscriber_on_stop():
+    stopped = []
+    subscriber = ZMQSubscriber('not-a-zmq-url', on_block=None, on_tx=None,
+                               on_stop=lambda: stopped.append(True))
+    asyncio.run(subscriber.run())
+    assert stopped == [True]